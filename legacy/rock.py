@@ -6,11 +6,36 @@
 #           UI Modals for All, Button Reset Fix
 # --------------------------------------------------------------------------
 
-from flask import Flask, Response, render_template_string, jsonify, request, session
-import uuid
+from flask import Flask, Response, g, render_template_string, jsonify, request, session
+import sys
 import random
 import os
 import time 
+import threading
+import json
+import sqlite3
+import heapq
+import atexit
+import gzip
+import hashlib
+import hmac
+import bisect
+import weakref
+import collections
+import itertools
+import marshal
+import zlib
+import tempfile
+
+try:
+    import brotli # Optional: adds a Brotli variant for the pre-built static assets
+except ImportError:
+    brotli = None
+
+try:
+    import numpy as np # Optional: lets decide_winners resolve whole arrays at once
+except ImportError:
+    np = None
 
 # --- FLASK APP AND DATABASE SETUP ---
 app = Flask(__name__)
@@ -29,8 +54,6 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 604800 # 7 days
 
 
 # --- GLOBAL GAME STATE (For 2-Player Asynchronous Mode) ---
-active_games = {}
-
 VALID_MOVES = {'rock', 'paper', 'scissors'}
 
 WIN_CONDITIONS_RPS = {
@@ -45,282 +68,3049 @@ AI_COUNTERS = {
     'scissors': 'rock'
 }
 
+# Moves encoded as small ints (0=rock, 1=paper, 2=scissors) for table lookups
+MOVE_ORDER = ('rock', 'paper', 'scissors')
+MOVE_INDEX = {move: index for index, move in enumerate(MOVE_ORDER)}
+
+# Outcomes from player 1's point of view, encoded the same way
+OUTCOME_TIE, OUTCOME_WIN, OUTCOME_LOSE = 0, 1, 2
+OUTCOME_NAMES = ('tie', 'win', 'lose')
+
+# OUTCOME_TABLE[move1][move2] is the outcome code for player 1
+OUTCOME_TABLE = tuple(
+    tuple(
+        OUTCOME_TIE if move1 == move2
+        else OUTCOME_WIN if (move1, move2) in WIN_CONDITIONS_RPS
+        else OUTCOME_LOSE
+        for move2 in MOVE_ORDER
+    )
+    for move1 in MOVE_ORDER
+)
+OUTCOME_MATRIX = np.array(OUTCOME_TABLE, dtype=np.int8) if np is not None else None
+
+# --- PUSH CHANNEL STATE (Long-Poll Room Updates) ---
+LONG_POLL_TIMEOUT = 25 # seconds a /api/game_updates request may block
+
+CHAT_HISTORY_LIMIT = 50 # chat messages kept per room
+
+# Fields of a room that are sent to clients (revision bookkeeping stays server-side)
+GAME_STATE_FIELDS = (
+    'id', 'p1_name', 'p1_avatar', 'p2_name', 'p2_avatar',
+    'p1_choice', 'p2_choice', 'status', 'result', 'created_at',
+    'revision', 'chat_messages', 'simultaneous', 'series'
+)
+HIDDEN_CHOICE = 'hidden' # What the other player sees of a move made during a simultaneous round
+
+# --- ROOM STORE CONFIGURATION ---
+# 'memory' keeps rooms in this process (single worker); 'sqlite' shares them
+# between every worker process on the box through a WAL-mode database file.
+ROOM_STORE_BACKEND = os.environ.get('RPS_ROOM_STORE', 'memory')
+ROOM_STORE_PATH = os.environ.get('RPS_ROOM_DB', os.path.join(basedir, 'rps_rooms.db'))
+ROOM_STORE_POLL_INTERVAL = 0.05 # seconds between cross-process revision checks
+ROOM_LOCK_STRIPES = 64 # striped writer locks shared by all in-memory rooms
+ROOM_CODE_ALPHABET = 'ABCDEFGHIJKLMNPQRSTUVWXYZ123456789' # Removed O, 0 for clarity
+ROOM_CODE_MIN_LENGTH = 4
+ROOM_CODE_MAX_LENGTH = 8
+ROOM_CODE_MAX_OCCUPANCY = 0.5 # hand out longer codes once this share of a length is in use
+ROOM_CODE_BLOCK = 64 # fresh codes a worker reserves at a time from the shared counter
+ROOM_CODE_KEY_BYTES = 16 # secret key of each code length's permutation
+ROOM_CODE_FEISTEL_ROUNDS = 6
+# The in-memory store is snapshotted to this file and reloaded at startup ('' disables).
+ROOM_SNAPSHOT_PATH = os.environ.get('RPS_ROOM_SNAPSHOT', os.path.join(basedir, 'rps_rooms.snapshot'))
+ROOM_SNAPSHOT_INTERVAL = 5 # seconds between snapshots (skipped while nothing changed)
+
+# --- ROOM EXPIRY CONFIGURATION ---
+# Seconds of inactivity after which a room is evicted, by status.
+ROOM_TTLS = {
+    'WAITING': 3600,
+    'P1_TURN': 1800,
+    'P2_TURN': 1800,
+    'PLAYING': 1800,
+    'RESOLVED': 900,
+}
+DEFAULT_ROOM_TTL = 3600
+EXPIRY_SWEEP_INTERVAL = 15 # seconds between background expiry sweeps
+
+# --- DATABASE CONFIGURATION ---
+DATABASE_PATH = os.environ.get('RPS_DATABASE', os.path.join(basedir, 'rps_data.db'))
+DB_FLUSH_INTERVAL = 2 # seconds between batched write-behind flushes
+DB_POOL_IDLE_LIMIT = 16 # idle connections kept for reuse by new threads
+USER_ID_CACHE_LIMIT = 10000 # username -> user row id mappings kept in memory
+DB_STATEMENT_CACHE = 128 # compiled statements sqlite3 keeps per connection
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL", # Durable at checkpoints; safe with WAL
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA cache_size=-16384", # 16 MB page cache per connection
+    "PRAGMA mmap_size=268435456", # Read through up to 256 MB of memory-mapped file
+    "PRAGMA temp_store=MEMORY",
+)
+AI_DEFAULT_MODE = os.environ.get('RPS_AI_MODE', 'frequency') # 'frequency' or 'markov'
+
+
+# --- METRICS (Prometheus Text Format at /metrics) ---
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REQUEST_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+AI_DECISION_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+CLEANUP_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+LABEL_VALUE_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+class MetricsRegistry:
+    """Counters and histograms that every thread updates in its own shard.
+
+    An update only touches the calling thread's dicts; a scrape adds the
+    shards up. A thread's first update registers its shard with one dict
+    store (no lock), and when the thread object is collected the shard is
+    folded into the retired totals under the lock, the same way
+    ConnectionPool recycles connections. Under a thread-per-request server
+    (werkzeug's threaded mode) each request therefore pays one registration
+    and one O(1) retirement; pooled threads (the ASGI executor, gunicorn's
+    gthread workers) pay them once for their whole life. Gauges (and
+    counters kept elsewhere, like evictions) are read from collector
+    callbacks at scrape time instead of being updated on the hot path.
+    """
+
+    def __init__(self):
+        self.families = {} # name -> (type, help text, buckets or collector)
+        self._local = threading.local()
+        self._shards = {} # shard id -> (counters, histograms) of a live thread
+        self._shard_ids = itertools.count()
+        self._retired = ({}, {})
+        self._lock = threading.RLock() # A thread may be collected (and retired) mid-scrape
+
+    def counter(self, name, help_text):
+        self.families[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self.families[name] = ('histogram', help_text, buckets)
+
+    def collected(self, name, kind, help_text, collect):
+        """A gauge or counter whose samples `collect()` returns as [(labels, value)]."""
+        self.families[name] = (kind, help_text, collect)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            shard_id = next(self._shard_ids) # count() and a dict store are atomic under the GIL
+            self._shards[shard_id] = shard
+            weakref.finalize(threading.current_thread(), self._retire, shard_id)
+        return shard
+
+    def _retire(self, shard_id):
+        with self._lock: # Merged and dropped together, so a scrape counts it exactly once
+            self._merge(self._retired, self._shards.pop(shard_id))
+
+    @staticmethod
+    def _merge(total, shard):
+        counters, histograms = total
+        for key, value in shard[0].copy().items():
+            counters[key] = counters.get(key, 0) + value
+        for key, slots in shard[1].copy().items():
+            slots = list(slots)
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = slots
+            else:
+                histograms[key] = [old + new for old, new in zip(merged, slots)]
+
+    def inc(self, name, labels=(), amount=1):
+        """Adds to a counter; `labels` is a tuple of (name, value) pairs."""
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        """Records one histogram sample (slots: one per bucket, +Inf, then the sum)."""
+        histograms = self._shard()[1]
+        key = (name, labels)
+        buckets = self.families[name][2]
+        slots = histograms.get(key)
+        if slots is None:
+            slots = histograms[key] = [0] * (len(buckets) + 2)
+        slots[bisect.bisect_left(buckets, value)] += 1
+        slots[-1] += value
+
+    def snapshot(self):
+        """Sums every shard: ({(name, labels): count}, {(name, labels): slots})."""
+        total = ({}, {})
+        with self._lock:
+            self._merge(total, self._retired)
+            for shard in list(self._shards.values()):
+                self._merge(total, shard)
+        return total
+
+    def render(self):
+        """All families in the Prometheus text exposition format."""
+        counters, histograms = self.snapshot()
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((labels, value))
+        for (name, labels), slots in histograms.items():
+            samples.setdefault(name, []).append((labels, slots))
+
+        lines = []
+        for name, (kind, help_text, extra) in self.families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if callable(extra):
+                for labels, value in extra():
+                    lines.append(f'{name}{format_labels(labels)} {format_metric_value(value)}')
+            elif kind == 'histogram':
+                for labels, slots in sorted(samples.get(name, ())):
+                    cumulative = 0
+                    for bound, count in zip(extra + ('+Inf',), slots):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else format_metric_value(bound)
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {format_metric_value(slots[-1])}')
+                    lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+            else:
+                for labels, value in sorted(samples.get(name, ())):
+                    lines.append(f'{name}{format_labels(labels)} {format_metric_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value).translate(LABEL_VALUE_ESCAPES)}"' for name, value in labels) + '}'
+
+def format_metric_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+metrics = MetricsRegistry()
+metrics.counter('rps_http_requests_total', "HTTP requests served, by route, method and status.")
+metrics.histogram('rps_http_request_duration_seconds', "Time to answer an HTTP request, by route (long-polls included).",
+                  REQUEST_LATENCY_BUCKETS)
+metrics.counter('rps_chat_messages_total', "Chat messages posted to rooms.")
+metrics.histogram('rps_ai_decision_seconds', "Time for the computer opponent to pick one move, by AI mode.",
+                  AI_DECISION_BUCKETS)
+metrics.histogram('rps_cleanup_duration_seconds', "Time taken by one room and ticket expiry sweep.", CLEANUP_BUCKETS)
+metrics.histogram('rps_room_snapshot_seconds', "Time taken to write one snapshot of the in-memory rooms.",
+                  CLEANUP_BUCKETS)
+metrics.counter('rps_background_errors_total', "Failures in background work, by task.")
+
+def room_status_samples():
+    return [((('status', status),), count) for status, count in sorted(room_store.status_counts().items())]
+
+def room_eviction_samples():
+    return [((('status', status),), count) for status, count in sorted(room_store.evictions.copy().items())]
+
+def room_code_samples(field):
+    return lambda: [((('length', str(length)),), stats[field]) for length, stats in room_store.codes.stats().items()]
+
+def write_behind_samples():
+    return [((('buffer', buffer.name),), len(buffer)) for buffer in write_behind_buffers]
+
+metrics.collected('rps_rooms', 'gauge', "Rooms currently stored, by status.", room_status_samples)
+metrics.collected('rps_room_evictions_total', 'counter', "Rooms evicted by expiry, by status.", room_eviction_samples)
+metrics.collected('rps_room_codes_live', 'gauge', "Room codes in use, by code length.", room_code_samples('live'))
+metrics.collected('rps_room_code_occupancy_ratio', 'gauge', "Share of each code length in use.",
+                  room_code_samples('occupancy'))
+metrics.collected('rps_match_waiting', 'gauge', "Players waiting for a random opponent.",
+                  lambda: [((), matchmaker.waiting_count())])
+metrics.collected('rps_matches_total', 'counter', "Random-opponent matches made.", lambda: [((), matchmaker.matches)])
+metrics.collected('rps_write_behind_pending', 'gauge', "Rows buffered for the next write-behind flush.",
+                  write_behind_samples)
+
+def record_request(route, method, status, seconds):
+    """Counts one answered HTTP request; shared by the Flask app and rock_asgi."""
+    metrics.inc('rps_http_requests_total', (('route', route), ('method', method), ('status', str(status))))
+    metrics.observe('rps_http_request_duration_seconds', seconds, (('route', route),))
+
+
+# --- PROFILING (Sampled Request Stacks) ---
+
+PROFILE_RATE = float(os.environ.get('RPS_PROFILE_RATE', '0')) # share of requests sampled (0 = off)
+PROFILE_DIR = os.environ.get('RPS_PROFILE_DIR', os.path.join(basedir, 'profiles'))
+PROFILE_INTERVAL = 0.005 # seconds between stack samples
+PROFILE_FLUSH_INTERVAL = 10 # seconds between rewrites of the .folded files
+ADMIN_TOKEN = os.environ.get('RPS_ADMIN_TOKEN') # unset disables the /admin/* endpoints
+
+class SamplingProfiler:
+    """Statistical profiler for a sampled share of requests.
+
+    A request picked by should_sample() registers its thread with begin().
+    While any request is registered, one background thread reads
+    sys._current_frames() every PROFILE_INTERVAL and counts each registered
+    thread's stack, collapsed into "outer;...;inner", under the request's
+    route. Requests that are not sampled pay one random() call. The counts
+    are written to one <route>.folded file per route, the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, rate, directory, interval=PROFILE_INTERVAL):
+        self.rate = rate
+        self.directory = directory
+        self.interval = interval
+        self.active = {} # thread ident -> route of the sampled request it is serving
+        self.stacks = {} # route -> {collapsed stack: samples}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dirty = False
+        if rate > 0:
+            self._start()
+
+    def should_sample(self):
+        return self.rate > 0 and random.random() < self.rate
+
+    def set_rate(self, rate):
+        self.rate = rate
+        if rate > 0:
+            self._start()
+
+    def begin(self, route):
+        ident = threading.get_ident()
+        self.active[ident] = route
+        return ident
+
+    def end(self, ident):
+        self.active.pop(ident, None)
+
+    def run(self, route, func, *args):
+        """Calls func(*args) with the current thread profiled under `route`."""
+        ident = self.begin(route)
+        try:
+            return func(*args)
+        finally:
+            self.end(ident)
+
+    def reset(self):
+        """Drops the samples collected so far and their .folded files."""
+        with self.lock:
+            routes, self.stacks = list(self.stacks), {}
+            self.dirty = False
+        for route in routes:
+            try:
+                os.remove(os.path.join(self.directory, profile_file_name(route)))
+            except FileNotFoundError:
+                pass
+
+    def status(self):
+        with self.lock:
+            samples = {route: sum(counts.values()) for route, counts in self.stacks.items()}
+        return {"rate": self.rate, "directory": self.directory, "samples": samples}
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sample_forever, name='rps-profiler', daemon=True)
+                self.thread.start()
+
+    def _sample_forever(self):
+        last_flush = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            if self.active:
+                self.sample()
+            if self.dirty and time.monotonic() - last_flush >= PROFILE_FLUSH_INTERVAL:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, route in list(self.active.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                counts = self.stacks.setdefault(route, {})
+                counts[stack] = counts.get(stack, 0) + 1
+                self.dirty = True
+
+    def flush(self):
+        """Rewrites every route's .folded file (atomically); returns the paths written."""
+        with self.lock:
+            snapshot = {route: dict(counts) for route, counts in self.stacks.items()}
+            self.dirty = False
+        if not snapshot:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        for route, counts in snapshot.items():
+            path = os.path.join(self.directory, profile_file_name(route))
+            with open(path + '.tmp', 'w') as folded:
+                for stack, samples in sorted(counts.items()):
+                    folded.write(f'{stack} {samples}\n')
+            os.replace(path + '.tmp', path)
+            paths.append(path)
+        return paths
+
+def collapse_stack(frame):
+    """One stack as "outer;...;inner", each frame named "function (file:first line)"."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def profile_file_name(route):
+    name = ''.join(char if char.isalnum() else '_' for char in route.strip('/'))
+    return (name or 'index') + '.folded'
+
+profiler = SamplingProfiler(PROFILE_RATE, PROFILE_DIR)
+atexit.register(profiler.flush)
+
+
+# --- ROOM MODEL (Compact Slotted Records) ---
+
+class ChatMessage:
+    """One chat line. Ids are small per-room integers rather than uuid4 strings."""
+
+    __slots__ = ('id', 'sender', 'text', 'timestamp', 'revision')
+
+    def __init__(self, message_id, sender, text, timestamp, revision):
+        self.id = message_id
+        self.sender = sys.intern(sender)
+        self.text = text
+        self.timestamp = timestamp
+        self.revision = revision
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "sender": self.sender,
+            "text": self.text,
+            "timestamp": self.timestamp,
+            "revision": self.revision
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['sender'], data['text'], data['timestamp'], data['revision'])
+
+
+class ChatLog:
+    """Fixed-capacity ring buffer of a room's chat, addressed by sequence number.
+
+    Message ids are consecutive sequence numbers, so message `seq` sits in
+    slot seq % capacity: appends never copy, and a cursor fetch only touches
+    the messages after the cursor. Slots are allocated on the first message.
+    """
+
+    __slots__ = ('capacity', 'slots', 'next_seq', 'count')
+
+    def __init__(self, capacity=CHAT_HISTORY_LIMIT, next_seq=1):
+        self.capacity = capacity
+        self.slots = None
+        self.next_seq = next_seq
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def first_seq(self):
+        return self.next_seq - self.count
+
+    def append(self, sender, text, revision):
+        seq = self.next_seq
+        chat_message = ChatMessage(seq, sender, text, time.time(), revision)
+        if self.slots is None:
+            self.slots = [None] * self.capacity
+        self.slots[seq % self.capacity] = chat_message
+        self.next_seq = seq + 1
+        if self.count < self.capacity:
+            self.count += 1
+        return chat_message
+
+    def copy(self):
+        """A new head over the same slots (for copy-on-write rooms)."""
+        chat = ChatLog(self.capacity, self.next_seq)
+        chat.slots = self.slots
+        chat.count = self.count
+        return chat
+
+    def _message(self, seq):
+        # Slots are shared with newer copies of the room, which may already
+        # have overwritten this one; the id check drops such messages. They
+        # overwrite oldest first, so everything before a dropped message is
+        # gone too, and readers walk back from the newest and stop there.
+        chat_message = self.slots[seq % self.capacity]
+        return chat_message if chat_message is not None and chat_message.id == seq else None
+
+    def after(self, seq):
+        """Returns the retained messages with a sequence number greater than `seq`."""
+        messages = list(itertools.takewhile(lambda chat_message: chat_message.id > seq, reversed(self)))
+        messages.reverse()
+        return messages
+
+    def __iter__(self):
+        return iter(self.after(0))
+
+    def __reversed__(self):
+        for s in range(self.next_seq - 1, self.first_seq - 1, -1):
+            chat_message = self._message(s)
+            if chat_message is None:
+                return # Overwritten, along with every older message
+            yield chat_message
+
+
+class RoundLog:
+    """Append-only log of a room's resolved rounds with running series tallies.
+
+    Each round is one nibble of `moves`: player 1's move code in the low two
+    bits, player 2's in the high two (codes index MOVE_ORDER), so two rounds
+    share a byte. Outcomes are recomputed from OUTCOME_TABLE when read, and
+    the tallies make series queries O(1). Writes are positional, so copies
+    can share the buffer the same way ChatLog shares its slots.
+    """
+
+    __slots__ = ('moves', 'rounds', 'p1_wins', 'p2_wins', 'ties')
+
+    def __init__(self):
+        self.moves = None # Allocated on the first round
+        self.rounds = 0
+        self.p1_wins = 0
+        self.p2_wins = 0
+        self.ties = 0
+
+    def __len__(self):
+        return self.rounds
+
+    def append(self, p1_choice, p2_choice):
+        move1, move2 = MOVE_INDEX[p1_choice], MOVE_INDEX[p2_choice]
+        index, high = divmod(self.rounds, 2)
+        if self.moves is None:
+            self.moves = bytearray()
+        if index == len(self.moves):
+            self.moves.append(0)
+        if high:
+            self.moves[index] = self.moves[index] & 0x0F | (move1 | move2 << 2) << 4
+        else:
+            self.moves[index] = move1 | move2 << 2
+        self.rounds += 1
+        outcome = OUTCOME_TABLE[move1][move2]
+        if outcome == OUTCOME_WIN:
+            self.p1_wins += 1
+        elif outcome == OUTCOME_LOSE:
+            self.p2_wins += 1
+        else:
+            self.ties += 1
+
+    def copy(self):
+        """A new head over the same buffer (for copy-on-write rooms)."""
+        log = object.__new__(RoundLog)
+        for field in self.__slots__:
+            setattr(log, field, getattr(self, field))
+        return log
+
+    def round(self, number):
+        """Round `number` (1-based) as (p1_choice, p2_choice, result)."""
+        index, high = divmod(number - 1, 2)
+        nibble = self.moves[index] >> 4 if high else self.moves[index] & 0x0F
+        move1, move2 = nibble & 0x03, nibble >> 2
+        return MOVE_ORDER[move1], MOVE_ORDER[move2], OUTCOME_NAMES[OUTCOME_TABLE[move1][move2]]
+
+    def after(self, number):
+        """Rounds numbered above `number`, as client dicts."""
+        return [
+            dict(zip(('round', 'p1_choice', 'p2_choice', 'result'), (n,) + self.round(n)))
+            for n in range(max(number, 0) + 1, self.rounds + 1)
+        ]
+
+    def series(self):
+        return {"rounds": self.rounds, "p1_wins": self.p1_wins, "p2_wins": self.p2_wins, "ties": self.ties}
+
+    def to_dict(self):
+        return {"rounds": self.rounds, "moves": bytes(self.moves or b'')[:(self.rounds + 1) // 2].hex()}
+
+    @classmethod
+    def from_dict(cls, data):
+        log = cls()
+        moves = bytes.fromhex(data['moves'])
+        for number in range(data['rounds']):
+            nibble = moves[number // 2] >> 4 * (number % 2) & 0x0F
+            log.append(MOVE_ORDER[nibble & 0x03], MOVE_ORDER[nibble >> 2])
+        return log
+
+
+class Room:
+    """A 2-player room. Player names are interned and chat is a fixed-size ring."""
+
+    __slots__ = (
+        'id', 'p1_name', 'p1_avatar', 'p2_name', 'p2_avatar',
+        'p1_choice', 'p2_choice', 'status', 'result', 'created_at',
+        'last_active', 'revision', 'field_revisions', 'chat_messages',
+        'simultaneous', 'round_log'
+    )
+
+    def __init__(self, room_code, p1_name, p1_avatar, created_at=None, simultaneous=False):
+        created_at = time.time() if created_at is None else created_at
+        self.id = room_code
+        self.p1_name = sys.intern(p1_name)
+        self.p1_avatar = sys.intern(p1_avatar)
+        self.p2_name = None
+        self.p2_avatar = None
+        self.p1_choice = None
+        self.p2_choice = None
+        self.status = 'WAITING'
+        self.result = None
+        self.created_at = created_at
+        self.last_active = created_at
+        self.revision = 0
+        self.field_revisions = {}
+        self.chat_messages = ChatLog()
+        self.simultaneous = simultaneous
+        self.round_log = RoundLog()
+
+    @property
+    def series(self):
+        """Running scores of every round this room has resolved."""
+        return self.round_log.series()
+
+    def record_round(self):
+        """Resolves the round from both choices and appends it to the round log."""
+        self.result = decide_winner(self.p1_choice, self.p2_choice)
+        self.status = 'RESOLVED'
+        self.round_log.append(self.p1_choice, self.p2_choice)
+
+    @property
+    def round_status(self):
+        """Status a round starts in: both players move at once (PLAYING) or P1 first."""
+        return 'PLAYING' if self.simultaneous else 'P1_TURN'
+
+    def copy(self):
+        """Private working copy for a transaction; the published room stays untouched."""
+        room = object.__new__(Room)
+        for field in self.__slots__:
+            setattr(room, field, getattr(self, field))
+        room.field_revisions = dict(self.field_revisions)
+        room.chat_messages = self.chat_messages.copy()
+        room.round_log = self.round_log.copy()
+        return room
+
+    def set_player2(self, name, avatar):
+        self.p2_name = sys.intern(name)
+        self.p2_avatar = sys.intern(avatar)
+
+    def add_chat_message(self, sender, text):
+        """Appends a message stamped with the revision it will be published at."""
+        return self.chat_messages.append(sender, text, self.revision + 1)
+
+    def to_dict(self):
+        """Full state for persistence (room stores, snapshots)."""
+        data = {field: getattr(self, field) for field in self.__slots__}
+        data['chat_messages'] = [chat_message.to_dict() for chat_message in self.chat_messages]
+        data['next_message_id'] = self.chat_messages.next_seq
+        data['round_log'] = self.round_log.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        room = cls(data['id'], data['p1_name'], data['p1_avatar'], data['created_at'])
+        for field in cls.__slots__:
+            if field not in ('id', 'p1_name', 'p1_avatar', 'created_at', 'chat_messages', 'simultaneous', 'round_log'):
+                setattr(room, field, data[field])
+        room.simultaneous = data.get('simultaneous', False) # Absent in rooms saved before the mode existed
+        if 'round_log' in data:
+            room.round_log = RoundLog.from_dict(data['round_log'])
+        if room.p2_name is not None:
+            room.set_player2(room.p2_name, room.p2_avatar)
+        room.field_revisions = dict(data['field_revisions'])
+        messages = data['chat_messages']
+        chat = ChatLog(next_seq=messages[0]['id'] if messages else data['next_message_id'])
+        for message in messages:
+            chat.append(message['sender'], message['text'], message['revision']).timestamp = message['timestamp']
+        room.chat_messages = chat
+        return room
+
+
+# --- DATA ACCESS (Pooled SQLite Connections) ---
+
+class ConnectionPool:
+    """Hands each thread its own long-lived connection to one SQLite file.
+
+    A thread keeps its connection for its whole life, so repeated queries
+    hit that connection's compiled-statement cache. When the thread object
+    is collected (e.g. a finished request thread), the connection goes back
+    to an idle list for the next new thread instead of being closed, so
+    the pragmas are paid once per connection, not once per request.
+    Connections are in autocommit mode; callers issue BEGIN themselves.
+    Nothing is opened until a thread asks. A forked child (gunicorn
+    --preload workers) starts with no connections: SQLite connections must
+    not be used across fork(), and closing them in the child could
+    checkpoint the parent's WAL, so the inherited ones are only kept
+    referenced.
+    """
+
+    def __init__(self, path, setup=None, pragmas=SQLITE_PRAGMAS):
+        self.path = path
+        self.pragmas = pragmas
+        self._setup = setup # Run once, on the first connection (schema, indexes)
+        self._local = threading.local()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._generation = 0 # Bumped in a forked child so the parent's connections never come back
+        self._inherited = []
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._checkout()
+            self._local.conn = conn
+            weakref.finalize(threading.current_thread(), self._checkin, conn, self._generation)
+        return conn
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            setup, self._setup = self._setup, None
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+            for pragma in self.pragmas:
+                conn.execute(pragma)
+            if setup is not None:
+                setup(conn)
+            return conn
+
+    def _checkin(self, conn, generation):
+        with self._lock:
+            if generation != self._generation: # Opened before a fork; see _after_fork
+                self._inherited.append(conn)
+                return
+            if len(self._idle) < DB_POOL_IDLE_LIMIT:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _after_fork(self):
+        conn = getattr(self._local, 'conn', None)
+        self._inherited += self._idle + ([conn] if conn is not None else [])
+        self._local = threading.local()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._generation += 1
+
+
+# --- ROOM CODES (Constant-Time Allocation) ---
+
+class CodeSpace:
+    """Every room code of one length, walked in a secret scrambled order.
+
+    Index i maps to code number permute(i), a keyed pseudorandom permutation
+    of [0, size): a balanced Feistel network over the smallest even number
+    of bits that covers size, cycle-walked until the result lands inside
+    it. Consecutive rooms therefore get unrelated codes without any
+    collision check, and without the key, codes already seen say nothing
+    about the ones that come next (rooms are private by their code).
+    Released codes go on a free list for reuse once the counter has been
+    used up.
+    """
+
+    __slots__ = ('length', 'size', 'key', 'hasher', 'half_bits', 'half_mask', 'next_index', 'free', 'live')
+
+    def __init__(self, length, key):
+        self.length = length
+        self.size = len(ROOM_CODE_ALPHABET) ** length
+        self.key = key
+        self.hasher = hashlib.blake2b(digest_size=8, key=key) # Copied per round; keying it is the slow part
+        self.half_bits = ((self.size - 1).bit_length() + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.next_index = 0 # Fresh indexes below this have been handed out
+        self.free = [] # Indexes of released codes
+        self.live = 0
+
+    def _round(self, round_number, half):
+        hasher = self.hasher.copy()
+        hasher.update(bytes((round_number,)) + half.to_bytes(8, 'big'))
+        return int.from_bytes(hasher.digest(), 'big') & self.half_mask
+
+    def permute(self, number):
+        while True:
+            left, right = number >> self.half_bits, number & self.half_mask
+            for round_number in range(ROOM_CODE_FEISTEL_ROUNDS):
+                left, right = right, left ^ self._round(round_number, right)
+            number = (left << self.half_bits) | right
+            if number < self.size:
+                return number
+
+    def unpermute(self, number):
+        while True:
+            left, right = number >> self.half_bits, number & self.half_mask
+            for round_number in reversed(range(ROOM_CODE_FEISTEL_ROUNDS)):
+                left, right = right ^ self._round(round_number, left), left
+            number = (left << self.half_bits) | right
+            if number < self.size:
+                return number
+
+    def code(self, index):
+        number = self.permute(index)
+        chars = []
+        for _ in range(self.length):
+            number, digit = divmod(number, len(ROOM_CODE_ALPHABET))
+            chars.append(ROOM_CODE_ALPHABET[digit])
+        return ''.join(chars)
+
+    def index(self, code):
+        """The counter index behind a code, or None if it is not a valid code."""
+        number = 0
+        for char in reversed(code):
+            digit = ROOM_CODE_ALPHABET.find(char)
+            if digit < 0:
+                return None
+            number = number * len(ROOM_CODE_ALPHABET) + digit
+        return self.unpermute(number)
+
+class RoomCodeAllocator:
+    """Hands out unused room codes in O(1) and widens codes under load.
+
+    New codes come from the shortest length whose occupancy is below
+    ROOM_CODE_MAX_OCCUPANCY: fresh codes from its permuted counter first,
+    then released ones from its free list. When a length fills up, new rooms
+    simply get one character more, and shorter codes come back into use as
+    their rooms expire.
+    """
+
+    def __init__(self):
+        self.spaces = {} # length -> CodeSpace
+        self.lock = threading.Lock()
+
+    def _space(self, length):
+        space = self.spaces.get(length)
+        if space is None:
+            space = self.spaces[length] = CodeSpace(length, self._key(length))
+        return space
+
+    def _key(self, length):
+        return os.urandom(ROOM_CODE_KEY_BYTES)
+
+    def _fresh_index(self, space):
+        if space.next_index == space.size:
+            return None
+        index = space.next_index
+        space.next_index += 1
+        return index
+
+    def allocate(self):
+        with self.lock:
+            for length in range(ROOM_CODE_MIN_LENGTH, ROOM_CODE_MAX_LENGTH + 1):
+                space = self._space(length)
+                if space.live >= space.size * ROOM_CODE_MAX_OCCUPANCY:
+                    continue
+                index = self._fresh_index(space)
+                if index is None:
+                    if not space.free:
+                        continue
+                    index = space.free.pop()
+                space.live += 1
+                return space.code(index)
+        raise RuntimeError("Room code space exhausted")
+
+    def release(self, room_code):
+        """Returns the code of a removed room to its free list."""
+        with self.lock:
+            space = self.spaces.get(len(room_code))
+            index = space.index(room_code) if space is not None else None
+            if index is None:
+                return
+            space.free.append(index)
+            space.live = max(0, space.live - 1)
+
+    def export_state(self):
+        """Counters for snapshots: {length: [permutation key, next index, free indexes]}."""
+        with self.lock:
+            return {length: [space.key, space.next_index, list(space.free)]
+                    for length, space in self.spaces.items()}
+
+    def load_state(self, state, live_codes):
+        """Restores export_state() output, with `live_codes` (the restored rooms) in use."""
+        in_use = {}
+        for room_code in live_codes:
+            in_use.setdefault(len(room_code), []).append(room_code)
+        with self.lock:
+            self.spaces = {}
+            for length, (key, next_index, free) in state.items():
+                space = self.spaces[length] = CodeSpace(length, key)
+                space.next_index = next_index
+                codes = in_use.get(length, ())
+                # A room deleted after the snapshot read the rooms is both saved and released.
+                live_indexes = {space.index(room_code) for room_code in codes}
+                space.free = [index for index in free if index not in live_indexes]
+                space.live = len(codes)
+
+    def stats(self):
+        """Occupancy of every code length handed out so far."""
+        with self.lock:
+            return {
+                length: {
+                    "capacity": space.size,
+                    "live": space.live,
+                    "issued": space.next_index,
+                    "free": len(space.free),
+                    "occupancy": space.live / space.size,
+                }
+                for length, space in sorted(self.spaces.items())
+            }
+
+class SharedRoomCodeAllocator(RoomCodeAllocator):
+    """Allocator whose counters live in the room database.
+
+    Worker processes reserve blocks of fresh indexes from one shared row per
+    code length, so no two workers hand out the same fresh code; each worker
+    reuses only the codes it released itself. Live counts are per worker
+    and are resynced from the rooms table after every expiry sweep.
+    """
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self.blocks = {} # length -> [next index, end of reserved block]
+
+    def _key(self, length):
+        conn = self.pool.connection()
+        conn.execute(
+            "INSERT OR IGNORE INTO room_code_counters (length, key, next_index) VALUES (?, ?, 0)",
+            (length, super()._key(length))
+        )
+        return conn.execute("SELECT key FROM room_code_counters WHERE length = ?", (length,)).fetchone()[0]
+
+    def _fresh_index(self, space):
+        block = self.blocks.get(space.length)
+        if block is None or block[0] == block[1]:
+            conn = self.pool.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                start = conn.execute(
+                    "SELECT next_index FROM room_code_counters WHERE length = ?", (space.length,)
+                ).fetchone()[0]
+                end = min(start + ROOM_CODE_BLOCK, space.size)
+                conn.execute("UPDATE room_code_counters SET next_index = ? WHERE length = ?", (end, space.length))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            block = self.blocks[space.length] = [start, end]
+            if start == end:
+                return None
+        index = block[0]
+        block[0] += 1
+        space.next_index = block[0]
+        return index
+
+    def sync_live(self, counts):
+        """Replaces the live counts with {length: rooms} read from the rooms table."""
+        with self.lock:
+            for length, space in self.spaces.items():
+                space.live = counts.get(length, 0)
+
+
+# --- ROOM STORE (Where Game State Lives) ---
+
+class RoomStore:
+    """Base class for room storage; routes only talk to rooms through this interface."""
+
+    def __init__(self):
+        self._conditions = {}
+        self._conditions_lock = threading.Lock()
+        self.evictions = {} # status -> rooms evicted by expire()
+        self.listeners = [] # callables(room_code) run after every change or eviction
+        self.codes = RoomCodeAllocator()
+
+    def get(self, room_code):
+        """Returns the room (or None) for reading only; mutations go through transaction()."""
+        raise NotImplementedError
+
+    def __contains__(self, room_code):
+        return self.get(room_code) is not None
+
+    def create(self, room_code, game):
+        """Stores a new room; returns False if the code is already taken."""
+        raise NotImplementedError
+
+    def delete(self, room_code):
+        raise NotImplementedError
+
+    def transaction(self, room_code):
+        """Context manager yielding the mutable room (or None) and saving it on exit."""
+        raise NotImplementedError
+
+    def expire(self, now):
+        """Evicts every room whose TTL has run out; returns the evicted codes."""
+        raise NotImplementedError
+
+    def status_counts(self):
+        """Returns {status: number of rooms} for the metrics endpoint."""
+        raise NotImplementedError
+
+    def _count_eviction(self, status):
+        self.evictions[status] = self.evictions.get(status, 0) + 1
+
+    def wait_for_change(self, room_code, since, timeout):
+        """Blocks until the room's revision passes `since`, it disappears, or timeout."""
+        raise NotImplementedError
+
+    def _condition(self, room_code):
+        with self._conditions_lock:
+            condition = self._conditions.get(room_code)
+            if condition is None:
+                condition = self._conditions[room_code] = threading.Condition()
+            return condition
+
+    def _notify(self, room_code, forget=False):
+        condition = self._condition(room_code)
+        with condition:
+            condition.notify_all()
+        if forget:
+            with self._conditions_lock:
+                self._conditions.pop(room_code, None)
+        for listener in self.listeners:
+            listener(room_code)
+
+
+class ExpiryQueue:
+    """Min-heap of room deadlines with lazy rescheduling.
+
+    Each room has at most one live heap entry. Activity that pushes a
+    deadline later does not touch the heap; the entry is re-pushed when it
+    surfaces. Only a deadline that moves earlier (e.g. a shorter TTL after a
+    status change) adds a new entry, so a sweep costs O(expired) pops.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = {} # room_code -> deadline of its live heap entry
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, room_code, deadline):
+        with self._lock:
+            scheduled = self._scheduled.get(room_code)
+            if scheduled is None or deadline < scheduled:
+                self._scheduled[room_code] = deadline
+                heapq.heappush(self._heap, (deadline, room_code))
+
+    def pop_due(self, now, current_deadline):
+        """Returns rooms whose deadline (per `current_deadline(code)`) has passed."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, room_code = heapq.heappop(self._heap)
+                if self._scheduled.get(room_code) != deadline:
+                    continue # Superseded by an earlier entry
+                actual = current_deadline(room_code)
+                if actual is None or actual <= now:
+                    del self._scheduled[room_code]
+                    if actual is not None:
+                        due.append(room_code)
+                else:
+                    self._scheduled[room_code] = actual
+                    heapq.heappush(self._heap, (actual, room_code))
+        return due
+
+
+class _RoomTransaction:
+    """Commits a room back to its store when the `with` block exits."""
+
+    def __init__(self, store, room_code):
+        self.store = store
+        self.room_code = room_code
+        self.game = None
+        self.start_revision = None
+
+    def __enter__(self):
+        self.game = self.store._begin(self.room_code)
+        if self.game is not None:
+            self.start_revision = self.game.revision
+        return self.game
+
+    def __exit__(self, exc_type, exc, tb):
+        changed = (exc_type is None and self.game is not None and
+                   self.game.revision != self.start_revision)
+        self.store._end(self.room_code, self.game, changed, exc_type is not None)
+        if changed:
+            self.store._notify(self.room_code)
+        return False
+
+
+class InMemoryRoomStore(RoomStore):
+    """Rooms kept in this process, safe under a threaded server.
+
+    Writers serialize per room on one of ROOM_LOCK_STRIPES striped locks and
+    work on a private copy of the room, which replaces the published one
+    when the transaction commits (copy-on-write). Published rooms are never
+    mutated, so get() and the long-poll readers take no lock at all.
+    """
+
+    def __init__(self, stripes=ROOM_LOCK_STRIPES):
+        super().__init__()
+        self.rooms = {} # room_code -> published (read-only) Room
+        self.expiry_queue = ExpiryQueue()
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._change_ids = itertools.count(1)
+        self.last_change = 0 # Moves whenever a room is published or removed
+
+    def _changed(self):
+        self.last_change = next(self._change_ids)
+
+    def _lock_for(self, room_code):
+        return self._stripes[hash(room_code) % len(self._stripes)]
+
+    def get(self, room_code):
+        return self.rooms.get(room_code)
+
+    def create(self, room_code, game):
+        with self._lock_for(room_code):
+            if room_code in self.rooms:
+                return False
+            self.rooms[room_code] = game
+            self.expiry_queue.schedule(room_code, room_expires_at(game))
+        self._changed()
+        return True
+
+    def delete(self, room_code):
+        with self._lock_for(room_code):
+            removed = self.rooms.pop(room_code, None)
+        if removed is not None:
+            self.codes.release(room_code)
+            self._changed()
+        self._notify(room_code, forget=True)
+
+    def transaction(self, room_code):
+        return _RoomTransaction(self, room_code)
+
+    def _begin(self, room_code):
+        lock = self._lock_for(room_code)
+        lock.acquire()
+        published = self.rooms.get(room_code)
+        return published.copy() if published is not None else None
+
+    def _end(self, room_code, game, changed, failed):
+        try:
+            if changed and room_code in self.rooms:
+                self.rooms[room_code] = game
+                self.expiry_queue.schedule(room_code, room_expires_at(game))
+                self._changed()
+        finally:
+            self._lock_for(room_code).release()
+
+    def expire(self, now):
+        expired = []
+        for room_code in self.expiry_queue.pop_due(now, self._current_deadline):
+            with self._lock_for(room_code):
+                game = self.rooms.get(room_code)
+                if game is None:
+                    continue
+                if room_expires_at(game) > now: # Touched after pop_due looked at it
+                    self.expiry_queue.schedule(room_code, room_expires_at(game))
+                    continue
+                del self.rooms[room_code]
+            self.codes.release(room_code)
+            self._changed()
+            self._count_eviction(game.status)
+            self._notify(room_code, forget=True)
+            expired.append(room_code)
+        return expired
+
+    def status_counts(self):
+        return collections.Counter(game.status for game in list(self.rooms.values()))
+
+    def snapshot_state(self):
+        """Returns (last change, published rooms, code counters) without taking a room lock.
+
+        Published rooms are never mutated, so copying the dict's values gives
+        a consistent set of rooms that can be serialized while writers carry
+        on. Rooms are read before the counters so every saved code counts as
+        handed out.
+        """
+        last_change = self.last_change
+        rooms = list(self.rooms.values())
+        return last_change, rooms, self.codes.export_state()
+
+    def restore_state(self, room_dicts, codes):
+        """Loads saved rooms (Room.to_dict() data) into an empty store; returns how many.
+
+        Rooms whose TTL ran out while the server was down are restored too
+        and left to the next expiry sweep, which releases their codes.
+        """
+        rooms = [Room.from_dict(room_data) for room_data in room_dicts]
+        for game in rooms:
+            self.rooms[game.id] = game
+            self.expiry_queue.schedule(game.id, room_expires_at(game))
+        self.codes.load_state(codes, self.rooms)
+        self._changed()
+        return len(rooms)
+
+    def revision(self, room_code):
+        game = self.rooms.get(room_code)
+        return game.revision if game is not None else None
+
+    def _current_deadline(self, room_code):
+        game = self.rooms.get(room_code)
+        return room_expires_at(game) if game is not None else None
+
+    def wait_for_change(self, room_code, since, timeout):
+        def changed():
+            game = self.rooms.get(room_code) # One read: delete() and expire() don't take the condition
+            return game is None or game.revision > since
+
+        condition = self._condition(room_code)
+        with condition:
+            return condition.wait_for(changed, timeout)
+
+
+class SqliteRoomStore(RoomStore):
+    """Rooms shared by every worker process through a WAL-mode SQLite file.
+
+    Each room is one row holding its JSON state; transactions take the
+    database write lock (BEGIN IMMEDIATE) so read-check-write sequences in
+    the routes stay atomic across processes.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.pool = ConnectionPool(path, setup=self._create_schema) # Schema is created on first use
+        self.codes = SharedRoomCodeAllocator(self.pool)
+
+    @staticmethod
+    def _create_schema(conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rooms ("
+            " code TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " revision INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " state TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_rooms_expires_at ON rooms (expires_at)")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(room_code_counters)")]
+        if columns and 'key' not in columns:
+            # Counters from the old guessable permutation; restarting them only
+            # costs a retry in store_new_room when a new code is still in use.
+            conn.execute("DROP TABLE room_code_counters")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS room_code_counters ("
+            " length INTEGER PRIMARY KEY,"
+            " key BLOB NOT NULL,"
+            " next_index INTEGER NOT NULL)"
+        )
+        # Shared matchmaking queue (SqliteMatchmaker)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS match_tickets ("
+            " id TEXT PRIMARY KEY,"
+            " username TEXT NOT NULL,"
+            " avatar TEXT,"
+            " tag TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " status TEXT NOT NULL,"
+            " room_code TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_match_tickets_queue ON match_tickets (status, tag, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_match_tickets_username ON match_tickets (username, status)")
+
+    def _connection(self):
+        return self.pool.connection()
+
+    def get(self, room_code):
+        row = self._connection().execute(
+            "SELECT state FROM rooms WHERE code = ?", (room_code,)
+        ).fetchone()
+        return Room.from_dict(json.loads(row[0])) if row else None
+
+    def create(self, room_code, game):
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO rooms (code, status, created_at, revision, expires_at, state)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (room_code, game.status, game.created_at, game.revision,
+             room_expires_at(game), json.dumps(game.to_dict()))
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, room_code):
+        cursor = self._connection().execute("DELETE FROM rooms WHERE code = ?", (room_code,))
+        if cursor.rowcount:
+            self.codes.release(room_code)
+        self._notify(room_code, forget=True)
+
+    def transaction(self, room_code):
+        return _RoomTransaction(self, room_code)
+
+    def _begin(self, room_code):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            return self.get(room_code)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _end(self, room_code, game, changed, failed):
+        conn = self._connection()
+        if failed:
+            conn.execute("ROLLBACK")
+            return
+        if changed:
+            conn.execute(
+                "UPDATE rooms SET status = ?, revision = ?, expires_at = ?, state = ? WHERE code = ?",
+                (game.status, game.revision, room_expires_at(game), json.dumps(game.to_dict()), room_code)
+            )
+        conn.execute("COMMIT")
+
+    def expire(self, now):
+        # The expires_at index makes this touch only the rows being evicted.
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT code, status FROM rooms WHERE expires_at <= ?", (now,)
+            ).fetchall()
+            conn.execute("DELETE FROM rooms WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.codes.sync_live(dict(conn.execute("SELECT length(code), COUNT(*) FROM rooms GROUP BY length(code)")))
+        for room_code, status in rows:
+            self.codes.release(room_code)
+            self._count_eviction(status)
+            self._notify(room_code, forget=True)
+        return [room_code for room_code, _ in rows]
+
+    def status_counts(self):
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM rooms GROUP BY status"))
+
+    def revision(self, room_code):
+        """The room's revision without decoding its state, or None if it is gone."""
+        row = self._connection().execute(
+            "SELECT revision FROM rooms WHERE code = ?", (room_code,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def wait_for_change(self, room_code, since, timeout):
+        # Local commits wake us immediately; commits from other workers are
+        # picked up by re-reading the revision every ROOM_STORE_POLL_INTERVAL.
+        deadline = time.monotonic() + timeout
+        condition = self._condition(room_code)
+        while True:
+            revision = self.revision(room_code)
+            if revision is None or revision > since:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with condition:
+                condition.wait(min(remaining, ROOM_STORE_POLL_INTERVAL))
+
+
+def room_expires_at(game):
+    """Deadline after which an idle room is evicted (TTL depends on its status)."""
+    return game.last_active + ROOM_TTLS.get(game.status, DEFAULT_ROOM_TTL)
+
+def create_room_store():
+    """Builds the room store selected by RPS_ROOM_STORE."""
+    if ROOM_STORE_BACKEND == 'sqlite':
+        return SqliteRoomStore(ROOM_STORE_PATH)
+    if ROOM_STORE_BACKEND != 'memory':
+        print(f"--- WARNING: Unknown RPS_ROOM_STORE '{ROOM_STORE_BACKEND}', using memory. ---")
+    return InMemoryRoomStore()
+
+room_store = create_room_store()
+
+
+# --- BACKGROUND TASKS (Started Once Per Serving Process) ---
+# Importing rock starts no threads: under `gunicorn --preload` the master
+# imports the app and then forks its workers, and threads do not survive a
+# fork. Each serving process calls start_worker() instead: `python rock.py`
+# and rock_asgi's lifespan do, other WSGI servers do from their worker hook
+# (e.g. gunicorn's post_worker_init). Processes without a hook (the Flask
+# test client, the bench) start the background loops on their first request.
+
+background_tasks = [] # (thread name, loop function) run in every serving process
+_background_pid = None # Process that started them; a forked child has to start its own
+_background_lock = threading.Lock()
+
+def register_background_task(name, target):
+    background_tasks.append((name, target))
+
+def start_background_tasks():
+    """Starts the registered background loops, once per process."""
+    global _background_pid
+    pid = os.getpid()
+    if _background_pid == pid:
+        return
+    with _background_lock:
+        if _background_pid == pid:
+            return
+        for name, target in background_tasks:
+            threading.Thread(target=target, name=name, daemon=True).start()
+        _background_pid = pid
+
+def start_worker():
+    """Per-process startup for server entry points and worker hooks."""
+    start_background_tasks()
+    start_room_snapshots()
+
+
+# --- ROOM SNAPSHOTS (In-Memory Rooms Survive Restarts) ---
+# A background thread writes the in-memory store to ROOM_SNAPSHOT_PATH and
+# the next process loads it before serving requests. The file is the magic
+# line followed by a zlib stream of length-prefixed marshal records: a header
+# with the code counters, then the rooms in chunks. Chunking keeps each
+# marshal call (which holds the GIL) short, so request threads keep running
+# during a snapshot.
+# Importing rock never touches the snapshot: start_worker() starts it in the
+# serving process, with a single worker as the in-memory store requires.
+# The SQLite store is already on disk and is not snapshotted.
+
+ROOM_SNAPSHOT_MAGIC = b'RPSROOMS2\n' # Version 2: keyed code permutations
+ROOM_SNAPSHOT_CHUNK = 256 # rooms per marshal record
+
+_snapshot_lock = threading.Lock() # One writer at a time (background thread vs. final save)
+_snapshot_stop = threading.Event()
+snapshot_thread = None
+
+def write_room_snapshot(store, path):
+    """Atomically replaces `path` with the store's current rooms; returns the change it covers."""
+    with _snapshot_lock:
+        started = time.perf_counter()
+        last_change, rooms, codes = store.snapshot_state()
+        compressor = zlib.compressobj()
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                         dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as snapshot:
+                snapshot.write(ROOM_SNAPSHOT_MAGIC)
+                snapshot.write(compressor.compress(
+                    snapshot_record({'saved_at': time.time(), 'rooms': len(rooms), 'codes': codes})))
+                for start in range(0, len(rooms), ROOM_SNAPSHOT_CHUNK):
+                    chunk = [game.to_dict() for game in rooms[start:start + ROOM_SNAPSHOT_CHUNK]]
+                    snapshot.write(compressor.compress(snapshot_record(chunk)))
+                snapshot.write(compressor.flush())
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        metrics.observe('rps_room_snapshot_seconds', time.perf_counter() - started)
+        return last_change
+
+def snapshot_record(value):
+    data = marshal.dumps(value)
+    return len(data).to_bytes(4, 'big') + data
+
+def read_room_snapshot(payload):
+    """Parses a snapshot file's bytes into (room dicts, code counters)."""
+    if not payload.startswith(ROOM_SNAPSHOT_MAGIC):
+        raise ValueError("not a room snapshot")
+    records = memoryview(zlib.decompress(payload[len(ROOM_SNAPSHOT_MAGIC):]))
+    values = []
+    position = 0
+    while position < len(records):
+        end = position + 4 + int.from_bytes(records[position:position + 4], 'big')
+        values.append(marshal.loads(records[position + 4:end]))
+        position = end
+    header, chunks = values[0], values[1:]
+    room_dicts = [room_data for chunk in chunks for room_data in chunk]
+    if len(room_dicts) != header['rooms']:
+        raise ValueError("truncated room snapshot")
+    return room_dicts, header['codes']
+
+def load_room_snapshot(store, path):
+    """Restores rooms saved by write_room_snapshot(); a missing or bad file starts empty."""
+    try:
+        with open(path, 'rb') as snapshot:
+            payload = snapshot.read()
+    except FileNotFoundError:
+        return 0
+    try:
+        count = store.restore_state(*read_room_snapshot(payload))
+    except Exception as e:
+        print(f"--- WARNING: Could not restore rooms from {path}: {e} ---")
+        return 0
+    print(f"Restored {count} game rooms from {path}")
+    return count
+
+def run_room_snapshots(store, path):
+    """Background loop that snapshots the store whenever it has changed."""
+    saved_change = None
+    while not _snapshot_stop.wait(ROOM_SNAPSHOT_INTERVAL):
+        if store.last_change == saved_change:
+            continue
+        try:
+            saved_change = write_room_snapshot(store, path)
+        except Exception as e:
+            print(f"Error writing room snapshot: {e}")
+            metrics.inc('rps_background_errors_total', (('task', 'snapshot'),))
+
+def start_room_snapshots():
+    """Restores the in-memory rooms and keeps snapshotting them (server entry points only)."""
+    global snapshot_thread
+    if not ROOM_SNAPSHOT_PATH or not isinstance(room_store, InMemoryRoomStore) or snapshot_thread is not None:
+        return
+    load_room_snapshot(room_store, ROOM_SNAPSHOT_PATH)
+    _snapshot_stop.clear()
+    snapshot_thread = threading.Thread(target=run_room_snapshots, args=(room_store, ROOM_SNAPSHOT_PATH),
+                                       name='rps-room-snapshot', daemon=True)
+    snapshot_thread.start()
+    atexit.register(stop_room_snapshots)
+
+def stop_room_snapshots():
+    """Stops the snapshot thread, then writes the final snapshot."""
+    global snapshot_thread
+    thread, snapshot_thread = snapshot_thread, None
+    if thread is None:
+        return
+    _snapshot_stop.set()
+    thread.join()
+    write_room_snapshot(room_store, ROOM_SNAPSHOT_PATH)
+
 
 # --- CORE SERVER LOGIC FUNCTIONS (Business Logic) ---
 
-def generate_room_code(length=4):
-    """Generates a simple, all-caps room code."""
-    chars = 'ABCDEFGHIJKLMNPQRSTUVWXYZ123456789' # Removed O, 0 for clarity
-    return ''.join(random.choice(chars) for _ in range(length))
+def store_new_room(game):
+    """Gives a new room an unused code from the allocator and stores it."""
+    game.id = room_store.codes.allocate()
+    while not room_store.create(game.id, game): # Only a code claimed outside this allocator can clash
+        game.id = room_store.codes.allocate()
+    return game.id
 
 def decide_winner(choice1, choice2):
     """Determines the winner based on choices (Player 1 is choice1)."""
-    if choice1 == choice2: 
-        return 'tie'
-    if (choice1, choice2) in WIN_CONDITIONS_RPS:
-        return 'win' # choice1 wins
-    return 'lose' # choice1 loses (choice2 wins)
+    return OUTCOME_NAMES[OUTCOME_TABLE[MOVE_INDEX[choice1]][MOVE_INDEX[choice2]]]
+
+def encode_moves(moves):
+    """Converts move names to move codes (a NumPy int8 array when NumPy is available)."""
+    codes = [MOVE_INDEX[move] for move in moves]
+    if np is not None:
+        return np.array(codes, dtype=np.int8)
+    return codes
+
+def decide_winners(moves1, moves2):
+    """Resolves many rounds at once from move codes; returns outcome codes.
+
+    With NumPy this is a single fancy-index into OUTCOME_MATRIX, so whole
+    arrays resolve without a Python-level loop. Map the result through
+    OUTCOME_NAMES to get 'tie'/'win'/'lose'. Codes outside range(3) raise
+    ValueError.
+    """
+    if np is not None:
+        moves1 = np.asarray(moves1, dtype=np.intp)
+        moves2 = np.asarray(moves2, dtype=np.intp)
+        if moves1.shape != moves2.shape:
+            raise ValueError("decide_winners needs arrays of the same shape")
+        # Fancy indexing would wrap a negative code around to another move
+        if not (((moves1 >= 0) & (moves1 < 3)).all() and ((moves2 >= 0) & (moves2 < 3)).all()):
+            raise ValueError("decide_winners needs move codes in range(3)")
+        return OUTCOME_MATRIX[moves1, moves2]
+    if len(moves1) != len(moves2):
+        raise ValueError("decide_winners needs sequences of the same length")
+    if not all(move in (0, 1, 2) for move in itertools.chain(moves1, moves2)):
+        raise ValueError("decide_winners needs move codes in range(3)")
+    return [OUTCOME_TABLE[move1][move2] for move1, move2 in zip(moves1, moves2)]
 
 def cleanup_stale_games():
-    """Iterates active_games and removes old, waiting rooms."""
+    """Evicts rooms that have been idle longer than their status TTL."""
+    started = time.perf_counter()
     try:
-        current_timestamp = time.time()
-        stale_rooms = []
-        for room_code, game in active_games.items():
-            if (game.get('status') == 'WAITING' and 
-                (current_timestamp - game.get('created_at', 0)) > 3600):
-                stale_rooms.append(room_code)
-        
-        for room_code in stale_rooms:
-            print(f"Cleaning up stale game room: {room_code}")
-            del active_games[room_code]
+        now = time.time()
+        stale_rooms = room_store.expire(now)
+        if stale_rooms:
+            print(f"Cleaned up {len(stale_rooms)} stale game rooms (evictions so far: {room_store.evictions})")
+        matchmaker.expire(now)
     except Exception as e:
         print(f"Error during game cleanup: {e}")
+        metrics.inc('rps_background_errors_total', (('task', 'cleanup'),))
+    metrics.observe('rps_cleanup_duration_seconds', time.perf_counter() - started)
+
+def run_expiry_sweeps():
+    """Background loop that keeps room expiry off the request path."""
+    while True:
+        time.sleep(EXPIRY_SWEEP_INTERVAL)
+        cleanup_stale_games()
+
+register_background_task('rps-room-expiry', run_expiry_sweeps)
+
+def mark_changed(game, *fields):
+    """Bumps a room's revision and records which fields changed at it."""
+    game.revision += 1
+    game.last_active = time.time()
+    for field in fields:
+        game.field_revisions[field] = game.revision
+
+def serialize_game(game, since=-1):
+    """Returns the client view of a room; only what changed after `since` if given."""
+    if since < 0:
+        state = {field: getattr(game, field) for field in GAME_STATE_FIELDS}
+        state['chat_messages'] = [chat_message.to_dict() for chat_message in game.chat_messages]
+        return hide_choices(game, state)
+
+    field_revisions = game.field_revisions
+    delta = {
+        field: getattr(game, field) for field in GAME_STATE_FIELDS
+        if field_revisions.get(field, 0) > since
+    }
+    if 'chat_messages' in delta:
+        new_messages = []
+        for chat_message in reversed(game.chat_messages):
+            if chat_message.revision <= since:
+                break
+            new_messages.append(chat_message.to_dict())
+        delta['chat_messages'] = new_messages[::-1]
+    delta['revision'] = game.revision
+    return hide_choices(game, delta)
+
+def hide_choices(game, state):
+    """Masks moves until a simultaneous round resolves, so neither player can peek."""
+    if game.status == 'PLAYING':
+        for field in ('p1_choice', 'p2_choice'):
+            if state.get(field):
+                state[field] = HIDDEN_CHOICE
+    return state
+
+# --- MATCHMAKING (Random-Opponent Queue) ---
+
+MATCH_WAIT_TTL = 120 # seconds a ticket waits for an opponent before it expires
+MATCH_TICKET_TTL = 300 # seconds a finished ticket stays readable
+MATCH_TAG_MAX_LENGTH = 20
+
+class MatchTicket:
+    """One player's request for a random opponent."""
+
+    __slots__ = ('id', 'username', 'avatar', 'tag', 'created_at', 'status', 'room_code', 'ready')
+
+    def __init__(self, username, avatar, tag):
+        self.id = os.urandom(8).hex()
+        self.username = username
+        self.avatar = avatar
+        self.tag = tag
+        self.created_at = time.time()
+        self.status = 'WAITING' # -> MATCHED, CANCELLED or EXPIRED
+        self.room_code = None
+        self.ready = threading.Event() # Set once the ticket stops WAITING
+
+    @classmethod
+    def from_row(cls, row):
+        """A ticket read back from the match_tickets table."""
+        ticket = object.__new__(cls)
+        (ticket.id, ticket.username, ticket.avatar, ticket.tag,
+         ticket.created_at, ticket.status, ticket.room_code) = row
+        ticket.ready = threading.Event()
+        if ticket.status != 'WAITING':
+            ticket.ready.set()
+        return ticket
+
+class Matchmaker:
+    """Pairs players waiting for a random opponent, one FIFO queue per tag.
+
+    Tags bucket players (e.g. by skill band or region) so only compatible
+    players meet. Enqueueing pops the oldest waiting ticket in the bucket,
+    so each pairing is O(1); cancelled tickets are skipped lazily when they
+    reach the front. The room is created with both players already in it,
+    inside the matchmaker lock, so nobody else can take the seat.
+    """
+
+    def __init__(self):
+        self.queues = {} # tag -> deque of tickets
+        self.tickets = {} # ticket id -> MatchTicket
+        self.waiting = {} # username -> their WAITING ticket
+        self.lock = threading.Lock()
+        self.listeners = [] # callables(ticket_id) run when a ticket stops waiting
+        self.matches = 0
+
+    def enqueue(self, username, avatar, tag):
+        """Returns the player's ticket, matched straight away if someone was waiting."""
+        with self.lock:
+            ticket = self.waiting.get(username)
+            if ticket is not None: # Asked twice; keep their place in the queue
+                return ticket
+            ticket = MatchTicket(username, avatar, tag)
+            self.tickets[ticket.id] = ticket
+            opponent = self._pop_waiting(tag)
+            if opponent is None:
+                self.queues.setdefault(tag, collections.deque()).append(ticket)
+                self.waiting[username] = ticket
+                return ticket
+
+            try:
+                room_code = self._create_room(opponent, ticket)
+            except Exception: # Give the opponent their place back; the new ticket never queued
+                self.queues.setdefault(tag, collections.deque()).appendleft(opponent)
+                del self.tickets[ticket.id]
+                raise
+            del self.waiting[opponent.username]
+            for matched in (opponent, ticket):
+                matched.status = 'MATCHED'
+                matched.room_code = room_code
+            self.matches += 1
+        self._notify(opponent)
+        self._notify(ticket)
+        return ticket
+
+    def _pop_waiting(self, tag):
+        queue = self.queues.get(tag)
+        if queue is None:
+            return None
+        opponent = None
+        while queue:
+            candidate = queue.popleft()
+            if candidate.status == 'WAITING':
+                opponent = candidate
+                break
+        if not queue:
+            del self.queues[tag]
+        return opponent
+
+    @staticmethod
+    def _new_room(first, second, room_code=None):
+        game = Room(room_code, first.username, first.avatar, simultaneous=True)
+        game.set_player2(second.username, second.avatar)
+        game.status = game.round_status
+        mark_changed(game, 'p2_name', 'p2_avatar', 'status')
+        return game
+
+    def _create_room(self, first, second):
+        return store_new_room(self._new_room(first, second))
+
+    def waiting_count(self):
+        return len(self.waiting)
+
+    def get(self, ticket_id):
+        return self.tickets.get(ticket_id)
+
+    def cancel(self, ticket):
+        with self.lock:
+            if ticket.status != 'WAITING':
+                return False
+            ticket.status = 'CANCELLED'
+            del self.waiting[ticket.username]
+        self._notify(ticket)
+        return True
+
+    def wait(self, ticket, timeout):
+        """Blocks until the ticket is matched, cancelled or expired, or until timeout."""
+        return ticket.ready.wait(timeout)
+
+    def expire(self, now):
+        """Expires tickets that waited too long and forgets old finished ones."""
+        expired = []
+        with self.lock:
+            for ticket_id, ticket in list(self.tickets.items()):
+                if ticket.status == 'WAITING':
+                    if now - ticket.created_at > MATCH_WAIT_TTL:
+                        ticket.status = 'EXPIRED'
+                        del self.waiting[ticket.username]
+                        expired.append(ticket)
+                elif now - ticket.created_at > MATCH_TICKET_TTL:
+                    del self.tickets[ticket_id]
+            for tag, queue in list(self.queues.items()):
+                live = collections.deque(ticket for ticket in queue if ticket.status == 'WAITING')
+                if live:
+                    self.queues[tag] = live
+                else:
+                    del self.queues[tag]
+        for ticket in expired:
+            self._notify(ticket)
+        return expired
+
+    def _notify(self, ticket):
+        ticket.ready.set()
+        for listener in self.listeners:
+            listener(ticket.id)
+
+class SqliteMatchmaker(Matchmaker):
+    """Matchmaking shared by every worker through the SQLite room database.
+
+    Tickets are rows in match_tickets, so find_match and the match_status
+    long-poll can land on different workers, and players queued on
+    different workers still meet. Pairing runs in one BEGIN IMMEDIATE
+    transaction on the same connection that inserts the room, so a waiting
+    player is matched exactly once. Local changes wake waiters at once;
+    matches made by other workers are seen by re-reading the ticket every
+    ROOM_STORE_POLL_INTERVAL.
+    """
+
+    COLUMNS = "id, username, avatar, tag, created_at, status, room_code"
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self._conditions = {} # ticket id -> Condition notified by local changes
+
+    def enqueue(self, username, avatar, tag):
+        while True:
+            # The allocator may take the database write lock itself, so the
+            # code is reserved before the transaction and released if unused.
+            room_code = room_store.codes.allocate()
+            try:
+                result = self._try_enqueue(username, avatar, tag, room_code)
+            except Exception: # Rolled back, so the opponent is still waiting
+                room_store.codes.release(room_code)
+                raise
+            if result is not None:
+                break
+        ticket, opponent = result
+        if opponent is None:
+            room_store.codes.release(room_code)
+            return ticket
+        self.matches += 1
+        self._notify(opponent)
+        self._notify(ticket)
+        return ticket
+
+    def _try_enqueue(self, username, avatar, tag, room_code):
+        """Returns (ticket, matched opponent or None), or None if room_code was taken."""
+        conn = self.pool.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT {self.COLUMNS} FROM match_tickets WHERE username = ? AND status = 'WAITING'", (username,)
+            ).fetchone()
+            if row is not None: # Asked twice; keep their place in the queue
+                conn.execute("COMMIT")
+                return MatchTicket.from_row(row), None
+
+            ticket = MatchTicket(username, avatar, tag)
+            row = conn.execute(
+                f"SELECT {self.COLUMNS} FROM match_tickets WHERE status = 'WAITING' AND tag = ?"
+                " ORDER BY created_at LIMIT 1", (tag,)
+            ).fetchone()
+            opponent = MatchTicket.from_row(row) if row is not None else None
+            if opponent is not None:
+                if not room_store.create(room_code, self._new_room(opponent, ticket, room_code)):
+                    conn.execute("ROLLBACK")
+                    return None
+                for matched in (opponent, ticket):
+                    matched.status = 'MATCHED'
+                    matched.room_code = room_code
+                conn.execute("UPDATE match_tickets SET status = 'MATCHED', room_code = ? WHERE id = ?",
+                             (room_code, opponent.id))
+            conn.execute(
+                f"INSERT INTO match_tickets ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (ticket.id, username, avatar, tag, ticket.created_at, ticket.status, ticket.room_code)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return ticket, opponent
+
+    def get(self, ticket_id):
+        row = self.pool.connection().execute(
+            f"SELECT {self.COLUMNS} FROM match_tickets WHERE id = ?", (ticket_id,)
+        ).fetchone()
+        return MatchTicket.from_row(row) if row is not None else None
+
+    def waiting_count(self):
+        return self.pool.connection().execute(
+            "SELECT COUNT(*) FROM match_tickets WHERE status = 'WAITING'"
+        ).fetchone()[0]
+
+    def cancel(self, ticket):
+        cursor = self.pool.connection().execute(
+            "UPDATE match_tickets SET status = 'CANCELLED' WHERE id = ? AND status = 'WAITING'", (ticket.id,)
+        )
+        if not cursor.rowcount:
+            return False
+        ticket.status = 'CANCELLED'
+        self._notify(ticket)
+        return True
+
+    def wait(self, ticket, timeout):
+        deadline = time.monotonic() + timeout
+        condition = self._condition(ticket.id)
+        try:
+            while True:
+                current = self.get(ticket.id)
+                if current is None or current.status != 'WAITING':
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                with condition:
+                    condition.wait(min(remaining, ROOM_STORE_POLL_INTERVAL))
+        finally:
+            with self.lock:
+                self._conditions.pop(ticket.id, None)
+
+    def _condition(self, ticket_id):
+        with self.lock:
+            condition = self._conditions.get(ticket_id)
+            if condition is None:
+                condition = self._conditions[ticket_id] = threading.Condition()
+            return condition
+
+    def expire(self, now):
+        conn = self.pool.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT {self.COLUMNS} FROM match_tickets WHERE status = 'WAITING' AND created_at < ?",
+                (now - MATCH_WAIT_TTL,)
+            ).fetchall()
+            conn.execute("UPDATE match_tickets SET status = 'EXPIRED' WHERE status = 'WAITING' AND created_at < ?",
+                         (now - MATCH_WAIT_TTL,))
+            conn.execute("DELETE FROM match_tickets WHERE status != 'WAITING' AND created_at < ?",
+                         (now - MATCH_TICKET_TTL,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        expired = [MatchTicket.from_row(row) for row in rows]
+        for ticket in expired:
+            ticket.status = 'EXPIRED'
+            self._notify(ticket)
+        return expired
+
+    def _notify(self, ticket):
+        with self.lock:
+            condition = self._conditions.get(ticket.id)
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+        super()._notify(ticket)
+
+def create_matchmaker():
+    """Matchmaking lives wherever the rooms do, so every worker sees the same queue."""
+    if isinstance(room_store, SqliteRoomStore):
+        return SqliteMatchmaker(room_store.pool)
+    return Matchmaker()
+
+matchmaker = create_matchmaker()
+
+
+# --- PERSISTENCE (rps_data.db With Batched Write-Behind) ---
+
+def _create_indexes(conn):
+    # ai__data lookups by user_id (and user_id, comp_last_move) already use
+    # the UNIQUE (user_id, comp_last_move, player_next_move) autoindex.
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_user_wins ON user (p_wins DESC, p_longest_streak DESC, username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_user_streak ON user (p_longest_streak DESC, p_wins DESC, username)")
+
+db_pool = ConnectionPool(DATABASE_PATH, setup=_create_indexes)
+
+def get_db():
+    """Returns this thread's connection to rps_data.db (autocommit mode)."""
+    return db_pool.connection()
+
+_user_ids = collections.OrderedDict() # username -> user row id, least recently used first
+_user_ids_lock = threading.Lock()
+
+def resolve_user_id(username, avatar=None):
+    """Maps a session username to its `user` row id, creating the row if needed."""
+    with _user_ids_lock:
+        user_id = _user_ids.get(username)
+        if user_id is not None:
+            _user_ids.move_to_end(username)
+            return user_id
+    conn = get_db()
+    conn.execute(
+        "INSERT OR IGNORE INTO user (username, password_hash, avatar_url, p_rounds_played, p_wins, p_longest_streak)"
+        " VALUES (?, '', ?, 0, 0, 0)",
+        (username, avatar or '')
+    )
+    user_id = conn.execute("SELECT id FROM user WHERE username = ?", (username,)).fetchone()[0]
+    with _user_ids_lock:
+        _user_ids[username] = user_id
+        while len(_user_ids) > USER_ID_CACHE_LIMIT:
+            _user_ids.popitem(last=False)
+    return user_id
+
+
+class WriteBehindBuffer:
+    """Accumulates writes in memory and hands them to `flush` in one batch.
+
+    `add` merges repeated keys (summing by default) so a hot key costs one
+    row per flush no matter how many times it was updated in between.
+    `flush_lock` is held from taking the batch until it is written, so a
+    holder sees every row either in the database or in pending().
+    """
+
+    def __init__(self, name, flush, merge=None):
+        self.name = name
+        self._flush = flush
+        self._merge = merge or (lambda old, new: old + new)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, value):
+        with self._lock:
+            old = self._pending.get(key)
+            self._pending[key] = value if old is None else self._merge(old, value)
+
+    def pending(self):
+        """A copy of the writes not yet handed to `flush`."""
+        with self._lock:
+            return dict(self._pending)
+
+    def flush(self):
+        with self.flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(f"Error flushing {self.name} ({len(batch)} rows): {e}")
+                metrics.inc('rps_background_errors_total', (('task', f'flush {self.name}'),))
+                for key, value in batch.items(): # Keep them for the next attempt
+                    self.add(key, value)
+                return 0
+            return len(batch)
+
+write_behind_buffers = []
+
+def register_write_behind(name, flush, merge=None):
+    buffer = WriteBehindBuffer(name, flush, merge)
+    write_behind_buffers.append(buffer)
+    return buffer
+
+def flush_write_behind():
+    for buffer in write_behind_buffers:
+        buffer.flush()
+
+def run_write_behind():
+    """Background loop that moves buffered writes to SQLite off the request path."""
+    while True:
+        time.sleep(DB_FLUSH_INTERVAL)
+        flush_write_behind()
+        try:
+            leaderboard.refresh() # On this thread, so its data_version check skips our own flushes
+        except Exception as e:
+            print(f"Error refreshing the leaderboard: {e}")
+            metrics.inc('rps_background_errors_total', (('task', 'leaderboard'),))
 
-# --- API ROUTES (HTTP Layer) ---
+register_background_task('rps-write-behind', run_write_behind)
+atexit.register(flush_write_behind) # Also in processes that never started the thread
 
-@app.route("/api/check_name", methods=["GET"])
-def check_name_api():
+
+# --- PLAYER STATS (Buffered Into the user Table) ---
+
+OPPOSITE_RESULTS = {'win': 'lose', 'lose': 'win', 'tie': 'tie'}
+LEADERBOARD_CAPACITY = 500 # players kept ranked in memory for each ordering
+LEADERBOARD_DEFAULT_LIMIT = 10
+LEADERBOARD_MAX_LIMIT = 100
+LEADERBOARD_OUTSIDE_LIMIT = 10000 # unranked players whose possible totals are tracked before a re-read
+WIN_STREAK_LIMIT = 10000 # players whose running win streak is remembered
+
+# username -> current run of round wins, for players on a streak. Streaks
+# only see the rounds this worker resolved; the stored longest streak is
+# the best run any single worker saw.
+_win_streaks = {}
+_win_streaks_lock = threading.Lock()
+
+def _merge_player_stats(old, new):
+    rounds, wins, streak, _ = old
+    return rounds + new[0], wins + new[1], max(streak, new[2]), new[3]
+
+def _flush_player_stats(batch):
+    conn = get_db()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(
+            "INSERT INTO user (username, password_hash, avatar_url, p_rounds_played, p_wins, p_longest_streak)"
+            " VALUES (?, '', ?, ?, ?, ?)"
+            " ON CONFLICT (username) DO UPDATE SET"
+            " avatar_url = COALESCE(NULLIF(excluded.avatar_url, ''), avatar_url),"
+            " p_rounds_played = COALESCE(p_rounds_played, 0) + excluded.p_rounds_played,"
+            " p_wins = COALESCE(p_wins, 0) + excluded.p_wins,"
+            " p_longest_streak = MAX(COALESCE(p_longest_streak, 0), excluded.p_longest_streak)",
+            [(username, avatar, rounds, wins, streak)
+             for username, (rounds, wins, streak, avatar) in batch.items()]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+player_stat_writes = register_write_behind('user stats', _flush_player_stats, _merge_player_stats)
+
+
+class Leaderboard:
+    """Top players by wins and by longest streak, kept current as rounds resolve.
+
+    Each ordering is a list of rank keys kept sorted with bisect and capped
+    at `capacity`, so a page is a slice and recording a round is O(log n)
+    with no query. Ranked players have exact totals. For everyone else only
+    an upper bound is kept: the last row read, plus whatever they won since.
+    Stats only grow, so the lists stay exact while no bound reaches the end
+    of a list; a bound that does marks the board stale.
+
+    The lists are read from the user table on first use, then re-read by
+    the write-behind thread when the board is stale or another worker has
+    committed to rps_data.db. A re-read holds the stats buffer's flush lock,
+    adds the rows still buffered and replays the rounds recorded while it
+    ran, so no round is counted twice or lost.
+    """
+
+    ORDERINGS = {
+        'wins': "p_wins DESC, p_longest_streak DESC, username",
+        'streak': "p_longest_streak DESC, p_wins DESC, username",
+    }
+
+    def __init__(self, capacity=LEADERBOARD_CAPACITY):
+        self.capacity = capacity
+        self.players = {} # username -> [avatar, rounds_played, wins, longest_streak], ranked players only
+        self.outside = {} # username -> [wins, longest_streak] an unranked player has at most
+        self.floor = (0, 0) # ... and the same bound for unranked players not in self.outside
+        self.rankings = {ordering: [] for ordering in self.ORDERINGS}
+        self.loaded = False
+        self.stale = False
+        self.journal = None # Rounds recorded while a re-read is running
+        self.data_version = None
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock() # One re-read at a time; never held by record()
+
+    @staticmethod
+    def rank_key(ordering, username, totals):
+        _, _, wins, longest = totals
+        if ordering == 'wins':
+            return (-wins, -longest, username)
+        return (-longest, -wins, username)
+
+    def record(self, username, avatar, rounds, wins, longest):
+        """Buffers a player's newly resolved rounds for the user table and re-ranks them."""
+        with self.lock: # Buffered under the lock so a re-read sees each round in exactly one place
+            player_stat_writes.add(username, (rounds, wins, longest, avatar or ''))
+            if self.journal is not None:
+                self.journal.append((username, avatar, rounds, wins, longest))
+            if self.loaded:
+                self._apply(username, avatar, rounds, wins, longest)
+
+    def _full(self):
+        return len(self.rankings['wins']) >= self.capacity
+
+    def _ranked(self, ordering, key):
+        ranking = self.rankings[ordering]
+        index = bisect.bisect_left(ranking, key)
+        return index < len(ranking) and ranking[index] == key
+
+    def _apply(self, username, avatar, rounds, wins, longest):
+        totals = self.players.get(username)
+        if totals is None:
+            if self._full():
+                self._apply_outside(username, wins, longest)
+                return
+            totals = self.players[username] = ['', 0, 0, 0] # Lists not full: every player is in them
+        old_keys = {ordering: self.rank_key(ordering, username, totals) for ordering in self.ORDERINGS}
+        totals[0] = avatar or totals[0]
+        totals[1] += rounds
+        totals[2] += wins
+        totals[3] = max(totals[3], longest)
+        for ordering, ranking in self.rankings.items():
+            old_key = old_keys[ordering]
+            index = bisect.bisect_left(ranking, old_key)
+            if index < len(ranking) and ranking[index] == old_key:
+                del ranking[index]
+            new_key = self.rank_key(ordering, username, totals)
+            if len(ranking) < self.capacity or new_key < ranking[-1]:
+                bisect.insort(ranking, new_key)
+                if len(ranking) > self.capacity:
+                    self._unrank(ranking.pop()[2])
+
+    def _unrank(self, username):
+        """Forgets a player's exact totals once they are in neither list."""
+        totals = self.players[username]
+        if any(self._ranked(ordering, self.rank_key(ordering, username, totals)) for ordering in self.ORDERINGS):
+            return
+        del self.players[username]
+        self.outside[username] = [totals[2], totals[3]]
+        if len(self.outside) > LEADERBOARD_OUTSIDE_LIMIT:
+            self.stale = True
+
+    def _apply_outside(self, username, wins, longest):
+        bound_wins, bound_longest = self.outside.get(username, self.floor)
+        if not wins and longest <= bound_longest:
+            return # Neither ranking key can have moved
+        bound_wins += wins
+        bound_longest = max(bound_longest, longest)
+        self.outside[username] = [bound_wins, bound_longest]
+        if (bound_wins >= -self.rankings['wins'][-1][0] or bound_longest >= -self.rankings['streak'][-1][0]
+                or len(self.outside) > LEADERBOARD_OUTSIDE_LIMIT):
+            self.stale = True # They may have climbed in; the next re-read has their real totals
+
+    def _read(self, pending):
+        """Reads the top rows, plus every player with buffered rounds; returns (rows, floor)."""
+        conn = get_db()
+        self.data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        rows = {}
+        floor = [0, 0]
+        for index, (ordering, order_by) in enumerate(self.ORDERINGS.items()):
+            top = conn.execute(
+                "SELECT username, avatar_url, p_rounds_played, p_wins, p_longest_streak FROM user"
+                f" ORDER BY {order_by} LIMIT ?",
+                (self.capacity,)
+            ).fetchall()
+            if len(top) == self.capacity: # Everyone below the last row has at most its value
+                floor[index] = top[-1][3 + index] or 0
+            rows.update((row[0], row) for row in top)
+        unread = [username for username in pending if username not in rows]
+        for start in range(0, len(unread), 500):
+            chunk = unread[start:start + 500]
+            rows.update((row[0], row) for row in conn.execute(
+                "SELECT username, avatar_url, p_rounds_played, p_wins, p_longest_streak FROM user"
+                f" WHERE username IN ({', '.join('?' * len(chunk))})", chunk
+            ))
+        return rows, tuple(floor)
+
+    def _reload(self):
+        with player_stat_writes.flush_lock: # No batch is between pending() and the table while we read
+            with self.lock:
+                self.journal = []
+                self.stale = False
+                pending = player_stat_writes.pending()
+            try:
+                rows, floor = self._read(pending)
+            except Exception:
+                with self.lock:
+                    self.journal = None
+                    self.stale = True
+                raise
+
+        totals = {username: [avatar or '', rounds or 0, wins or 0, longest or 0]
+                  for username, avatar, rounds, wins, longest in rows.values()}
+        for username, (rounds, wins, longest, avatar) in pending.items():
+            player = totals.setdefault(username, ['', 0, 0, 0])
+            player[0] = avatar or player[0]
+            player[1] += rounds
+            player[2] += wins
+            player[3] = max(player[3], longest)
+        rankings = {ordering: sorted(self.rank_key(ordering, username, player)
+                                     for username, player in totals.items())[:self.capacity]
+                    for ordering in self.ORDERINGS}
+        ranked = {key[2] for ranking in rankings.values() for key in ranking}
+
+        with self.lock:
+            journal, self.journal = self.journal, None
+            self.players = {username: totals[username] for username in ranked}
+            self.outside = {username: [player[2], player[3]] for username, player in totals.items()
+                            if username not in ranked}
+            self.floor = floor
+            self.rankings = rankings
+            self.loaded = True
+            for entry in journal:
+                self._apply(*entry)
+
+    def refresh(self):
+        """Re-reads the lists if they may be wrong; run by the write-behind thread."""
+        if not self.loaded:
+            return # Nobody has asked for a page yet
+        if not self.stale:
+            version = get_db().execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return # No other connection has committed since the last read
+        with self.load_lock:
+            self._reload()
+
+    def top(self, ordering, limit):
+        if not self.loaded:
+            with self.load_lock: # Cold start: the first reader loads, the others wait for it
+                if not self.loaded:
+                    self._reload()
+        with self.lock:
+            page = []
+            for rank, (_, _, username) in enumerate(self.rankings[ordering][:limit], 1):
+                avatar, rounds, wins, longest = self.players[username]
+                page.append({
+                    "rank": rank,
+                    "username": username,
+                    "avatar": avatar,
+                    "wins": wins,
+                    "longest_streak": longest,
+                    "rounds_played": rounds
+                })
+            return page
+
+leaderboard = Leaderboard()
+
+def _advance_win_streak(username, results):
+    """Runs `results` through the player's current win streak; returns (wins, longest run)."""
+    wins = 0
+    longest = 0
+    with _win_streaks_lock:
+        streak = _win_streaks.pop(username, 0) # Re-inserted at the end, so the dict stays in LRU order
+        for result in results:
+            if result == 'win':
+                wins += 1
+                streak += 1
+                longest = max(longest, streak)
+            else:
+                streak = 0
+        if streak:
+            _win_streaks[username] = streak
+            if len(_win_streaks) > WIN_STREAK_LIMIT:
+                del _win_streaks[next(iter(_win_streaks))] # Forget the longest-idle streak
+    return wins, longest
+
+def record_player_rounds(username, avatar, results):
+    """Buffers resolved rounds for a player; `results` are 'win'/'lose'/'tie' from their side."""
+    wins, longest = _advance_win_streak(username, results)
+    leaderboard.record(username, avatar, len(results), wins, longest)
+
+def record_room_round(game):
+    """Counts a resolved multiplayer round for both players."""
+    record_player_rounds(game.p1_name, game.p1_avatar, (game.result,))
+    record_player_rounds(game.p2_name, game.p2_avatar, (OPPOSITE_RESULTS[game.result],))
+
+
+# --- COMPUTER OPPONENT (AI Engines) ---
+
+AI_HISTORY_WINDOW = 20 # player moves the frequency model remembers
+AI_SMART_RATE = 0.7 # share of rounds where the AI plays its prediction
+BULK_PLAY_LIMIT = 1000 # rounds accepted by one /api/play_computer_bulk request
+MARKOV_MODEL_CACHE_LIMIT = 10000 # users whose Markov transition counts stay in memory
+
+class FrequencyAI:
+    """Counters the player's most frequent move over a sliding window.
+
+    Running per-move counts make each prediction O(1). The window itself is
+    packed two bits per move into one int (newest move in the low bits), so
+    the session cookie carries a few small numbers instead of a move list.
+    """
+
+    SESSION_KEY = 'ai_state'
+    WINDOW_MASK = (1 << (2 * AI_HISTORY_WINDOW)) - 1
+
+    def __init__(self, counts=None, window=0, size=0):
+        self.counts = list(counts) if counts else [0, 0, 0]
+        self.window = window
+        self.size = size
+
+    @classmethod
+    def from_session(cls, session_data):
+        state = session_data.get(cls.SESSION_KEY)
+        if state:
+            counts, window, size = state
+            return cls(counts, window, size)
+        engine = cls()
+        for move in session_data.get('player_moves', []): # Sessions from before ai_state
+            if move in MOVE_INDEX:
+                engine.observe(move)
+        return engine
+
+    def to_session(self, session_data):
+        session_data[self.SESSION_KEY] = [self.counts, self.window, self.size]
+        session_data.pop('player_moves', None)
+
+    def observe(self, move):
+        """Adds the player's move, dropping the oldest once the window is full."""
+        if self.size == AI_HISTORY_WINDOW:
+            oldest = (self.window >> (2 * (AI_HISTORY_WINDOW - 1))) & 3
+            self.counts[oldest] -= 1
+        else:
+            self.size += 1
+        index = MOVE_INDEX[move]
+        self.window = ((self.window << 2) | index) & self.WINDOW_MASK
+        self.counts[index] += 1
+
+    def predict(self):
+        """Returns the player's most frequent recent move, or None with no history."""
+        if not self.size:
+            return None
+        counts = self.counts
+        return MOVE_ORDER[max(range(3), key=counts.__getitem__)]
+
+    def choose(self):
+        """Picks the computer's move: counter the prediction, or play randomly."""
+        if random.random() < AI_SMART_RATE:
+            predicted = self.predict()
+            if predicted:
+                return AI_COUNTERS[predicted]
+        return random.choice(MOVE_ORDER)
+
+    def play(self, player_choice):
+        """Plays one round (the move counts before predicting); returns the computer move."""
+        self.observe(player_choice)
+        return self.choose()
+
+def _flush_ai_transitions(batch):
+    conn = get_db()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(
+            "INSERT INTO ai__data (user_id, comp_last_move, player_next_move, count) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (user_id, comp_last_move, player_next_move)"
+            " DO UPDATE SET count = COALESCE(count, 0) + excluded.count",
+            [(user_id, comp_last, player_next, amount)
+             for (user_id, comp_last, player_next), amount in batch.items()]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+ai_transition_writes = register_write_behind('ai__data', _flush_ai_transitions)
+
+# user_id -> {comp_last_move: [rock, paper, scissors counts]}, least recently used first
+_markov_models = collections.OrderedDict()
+_markov_models_lock = threading.Lock()
+
+def _read_markov_model(user_id):
+    """Reads a user's transition counts from ai__data plus the increments not yet flushed."""
+    model = {move: [0, 0, 0] for move in MOVE_ORDER}
+    with ai_transition_writes.flush_lock: # Every increment is in the table or still buffered
+        rows = get_db().execute(
+            "SELECT comp_last_move, player_next_move, count FROM ai__data WHERE user_id = ?",
+            (user_id,)
+        ).fetchall()
+        pending = ai_transition_writes.pending()
+    for comp_last, player_next, count in rows:
+        if comp_last in model and player_next in MOVE_INDEX:
+            model[comp_last][MOVE_INDEX[player_next]] = count or 0
+    for (pending_user, comp_last, player_next), amount in pending.items(): # Set when the model was evicted
+        if pending_user == user_id:
+            model[comp_last][MOVE_INDEX[player_next]] += amount
+    return model
+
+def load_markov_model(user_id):
+    """Returns the cached transition counts for a user, reading them on a cache miss."""
+    with _markov_models_lock:
+        model = _markov_models.get(user_id)
+        if model is not None:
+            _markov_models.move_to_end(user_id)
+            return model
+    model = _read_markov_model(user_id)
+    with _markov_models_lock:
+        model = _markov_models.setdefault(user_id, model) # Another thread may have read it first
+        _markov_models.move_to_end(user_id)
+        while len(_markov_models) > MARKOV_MODEL_CACHE_LIMIT:
+            _markov_models.popitem(last=False)
+    return model
+
+class MarkovAI:
+    """Predicts the player's reply to the computer's previous move.
+
+    Transition counts live in ai__data; this engine reads them through the
+    in-memory model cache and queues increments on the write-behind buffer,
+    so a round never waits on SQLite.
+    """
+
+    SESSION_KEY = 'ai_last_comp'
+
+    def __init__(self, user_id, last_comp=None):
+        self.user_id = user_id
+        self.model = load_markov_model(user_id)
+        self.last_comp = last_comp
+
+    @classmethod
+    def from_session(cls, session_data, user_id):
+        return cls(user_id, session_data.get(cls.SESSION_KEY))
+
+    def to_session(self, session_data):
+        session_data[self.SESSION_KEY] = self.last_comp
+
+    def predict(self):
+        """Returns the player's most likely next move, or None with no data."""
+        if self.last_comp is None:
+            return None
+        counts = self.model[self.last_comp]
+        if not any(counts):
+            return None
+        return MOVE_ORDER[max(range(3), key=counts.__getitem__)]
+
+    def play(self, player_choice):
+        """Plays one round and learns the player's reply; returns the computer move."""
+        computer_choice = None
+        if random.random() < AI_SMART_RATE:
+            predicted = self.predict()
+            if predicted:
+                computer_choice = AI_COUNTERS[predicted]
+        if not computer_choice:
+            computer_choice = random.choice(MOVE_ORDER)
+
+        if self.last_comp is not None:
+            self.model[self.last_comp][MOVE_INDEX[player_choice]] += 1
+            ai_transition_writes.add((self.user_id, self.last_comp, player_choice), 1)
+        self.last_comp = computer_choice
+        return computer_choice
+
+
+def load_ai_engine(ai_mode, user_session):
+    """Builds the requested AI engine from a player's session."""
+    username = user_session.get('username')
+    if ai_mode == 'markov' and username: # The Markov model is stored per user
+        return MarkovAI.from_session(user_session, resolve_user_id(username, user_session.get('avatar')))
+    return FrequencyAI.from_session(user_session)
+
+def parse_ndjson_choices(text):
+    """Reads one choice (or {"p1_choice": ...}) per line; returns None if malformed."""
+    try:
+        lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError:
+        return None
+    return [line.get('p1_choice') if isinstance(line, dict) else line for line in lines]
+
+# --- GAME ACTIONS (Framework-Independent Business Logic) ---
+# Each action takes the player's session (a dict) and request data and
+# returns (body, status). The Flask routes below and the ASGI server in
+# rock_asgi.py are thin adapters around these.
+
+def check_name_action(user_session):
     """Checks if a user is already logged in via the session."""
-    username = session.get('username')
-    avatar = session.get('avatar') 
+    username = user_session.get('username')
+    avatar = user_session.get('avatar') 
     if not username or not avatar: 
-        return jsonify({"success": False, "loggedIn": False})
+        return {"success": False, "loggedIn": False}, 200
     
-    session.permanent = True 
-    return jsonify({
+    user_session.permanent = True 
+    return {
         "success": True,
         "loggedIn": True,
         "username": username,
         "avatar": avatar 
-    })
+    }, 200
 
-@app.route("/api/set_name", methods=["POST"])
-def set_name_api():
-    data = request.get_json()
+def set_name_action(user_session, data):
     username = data.get('username', '').strip()
     avatar = data.get('avatar', '').strip() 
     
     if not username or len(username) < 2:
-        return jsonify({"success": False, "message": "Name must be at least 2 characters."}), 400
+        return {"success": False, "message": "Name must be at least 2 characters."}, 400
     if len(username) > 20:
-        return jsonify({"success": False, "message": "Name must be 20 characters or less."}), 400
+        return {"success": False, "message": "Name must be 20 characters or less."}, 400
     if not avatar: 
-        return jsonify({"success": False, "message": "You must select an avatar."}), 400
+        return {"success": False, "message": "You must select an avatar."}, 400
 
-    session['username'] = username
-    session['avatar'] = avatar 
-    session.permanent = True 
-    return jsonify({
+    user_session['username'] = username
+    user_session['avatar'] = avatar 
+    user_session.permanent = True 
+    return {
         "success": True,
         "username": username,
         "avatar": avatar
-    })
-
-@app.route("/api/change_name", methods=["POST"])
-def change_name_api():
-    session.pop('username', None)
-    session.pop('avatar', None) 
-    session.pop('player_moves', None) 
-    return jsonify({"success": True})
+    }, 200
 
+def change_name_action(user_session):
+    user_session.pop('username', None)
+    user_session.pop('avatar', None) 
+    user_session.pop('player_moves', None) 
+    user_session.pop(FrequencyAI.SESSION_KEY, None) 
+    user_session.pop(MarkovAI.SESSION_KEY, None) 
+    return {"success": True}, 200
 
-@app.route("/api/play_computer", methods=["POST"])
-def play_computer_api():
-    data = request.get_json()
+def play_computer_action(user_session, data):
     player1_choice = data.get('p1_choice')
 
-    if player1_choice not in VALID_MOVES:
-        return jsonify({"success": False, "message": "Invalid move choice."}), 400
+    if not isinstance(player1_choice, str) or player1_choice not in VALID_MOVES:
+        return {"success": False, "message": "Invalid move choice."}, 400
     
+    ai_mode = data.get('ai_mode', AI_DEFAULT_MODE)
+    if ai_mode not in ('frequency', 'markov'):
+        return {"success": False, "message": "Unknown AI mode."}, 400
+
     # --- SMARTER AI LOGIC ---
-    player_moves = session.get('player_moves', [])
-    player_moves.append(player1_choice)
-    session['player_moves'] = player_moves[-20:] 
-    
-    computer_choice = None
-    
-    if player_moves and random.random() < 0.7: # 70% smart
-        try:
-            most_frequent_move = max(set(player_moves), key=player_moves.count)
-            computer_choice = AI_COUNTERS[most_frequent_move]
-            
-        except Exception as e:
-            print(f"AI error: {e}") 
-            
-    if not computer_choice: # 30% random
-        computer_choice = random.choice(list(VALID_MOVES))
+    ai_engine = load_ai_engine(ai_mode, user_session)
+    started = time.perf_counter()
+    computer_choice = ai_engine.play(player1_choice)
+    metrics.observe('rps_ai_decision_seconds', time.perf_counter() - started, (('mode', ai_mode),))
+    ai_engine.to_session(user_session)
     # --- END SMARTER AI LOGIC ---
     
     result = decide_winner(player1_choice, computer_choice)
+    if user_session.get('username'):
+        record_player_rounds(user_session['username'], user_session.get('avatar'), (result,))
 
-    return jsonify({
+    return {
         "result": result,
         "p1_choice": player1_choice,
         "p2_choice": computer_choice
-    })
-
-# --- [ NETWORKED MULTIPLAYER ROUTES ] ---
-
-@app.route("/api/create_room", methods=["POST"])
-def create_room_api():
-    cleanup_stale_games()
-    
-    player_name = session.get('username')
-    player_avatar = session.get('avatar') 
+    }, 200
+
+def play_computer_bulk_action(user_session, choices, ai_mode):
+    """Plays many computer rounds in order, updating the session once."""
+    if not isinstance(choices, list) or not choices:
+        return {"success": False, "message": "Send a non-empty list of choices."}, 400
+    if len(choices) > BULK_PLAY_LIMIT:
+        return {"success": False, "message": f"At most {BULK_PLAY_LIMIT} rounds per request."}, 413
+    for index, choice in enumerate(choices):
+        if not isinstance(choice, str) or choice not in VALID_MOVES: # Lists and dicts are unhashable
+            return {"success": False, "message": f"Invalid move choice at index {index}."}, 400
+    if ai_mode not in ('frequency', 'markov'):
+        return {"success": False, "message": "Unknown AI mode."}, 400
+
+    ai_engine = load_ai_engine(ai_mode, user_session)
+    results = []
+    totals = {'win': 0, 'lose': 0, 'tie': 0}
+    labels = (('mode', ai_mode),)
+    for player1_choice in choices:
+        started = time.perf_counter()
+        computer_choice = ai_engine.play(player1_choice)
+        metrics.observe('rps_ai_decision_seconds', time.perf_counter() - started, labels)
+        result = decide_winner(player1_choice, computer_choice)
+        totals[result] += 1
+        results.append({"result": result, "p1_choice": player1_choice, "p2_choice": computer_choice})
+    ai_engine.to_session(user_session)
+    if user_session.get('username'):
+        record_player_rounds(user_session['username'], user_session.get('avatar'),
+                             [round_result['result'] for round_result in results])
+    return {"success": True, "results": results, "totals": totals}, 200
+
+def create_room_action(user_session, data):
+    player_name = user_session.get('username')
+    player_avatar = user_session.get('avatar') 
     if not player_name or not player_avatar:
-        return jsonify({"success": False, "message": "Not authenticated"}), 403
+        return {"success": False, "message": "Not authenticated"}, 403
 
-    room_code = generate_room_code()
-    while room_code in active_games:
-        room_code = generate_room_code()
+    game = Room(None, player_name, player_avatar, simultaneous=bool(data.get('simultaneous')))
+    room_code = store_new_room(game)
     
-    active_games[room_code] = {
-        'id': room_code,
-        'p1_name': player_name,
-        'p1_avatar': player_avatar, 
-        'p2_name': None,
-        'p2_avatar': None, 
-        'p1_choice': None,
-        'p2_choice': None,
-        'status': 'WAITING', 
-        'result': None,
-        'created_at': time.time(),
-        'chat_messages': [] 
-    }
-    return jsonify({"success": True, "room_code": room_code, "player_name": player_name})
+    return {"success": True, "room_code": room_code, "player_name": player_name}, 200
 
-@app.route("/api/join_room", methods=["POST"])
-def join_room_api():
-    player_name = session.get('username')
-    player_avatar = session.get('avatar') 
+def join_room_action(user_session, data):
+    player_name = user_session.get('username')
+    player_avatar = user_session.get('avatar') 
     if not player_name or not player_avatar:
-        return jsonify({"success": False, "message": "Not authenticated"}), 403
+        return {"success": False, "message": "Not authenticated"}, 403
     
-    data = request.get_json()
     room_code = data.get('room_code', '').upper()
     
-    if room_code not in active_games:
-        return jsonify({"success": False, "message": "Room code not found."}), 404
-    
-    game = active_games[room_code]
-    
-    if game['p2_name'] is not None and game['p1_name'] != player_name:
-        return jsonify({"success": False, "message": "This room is already full."}), 409
-    
-    if game['p1_name'] == player_name:
-        return jsonify({"success": False, "message": "You can't join your own game."}), 400
+    with room_store.transaction(room_code) as game:
+        if game is None:
+            return {"success": False, "message": "Room code not found."}, 404
         
-    game['p2_name'] = player_name
-    game['p2_avatar'] = player_avatar 
-    game['status'] = 'P1_TURN' 
+        if game.p2_name is not None and game.p1_name != player_name:
+            return {"success": False, "message": "This room is already full."}, 409
+        
+        if game.p1_name == player_name:
+            return {"success": False, "message": "You can't join your own game."}, 400
+            
+        game.set_player2(player_name, player_avatar)
+        game.status = game.round_status 
+        mark_changed(game, 'p2_name', 'p2_avatar', 'status')
     
-    return jsonify({
+    return {
         "success": True, 
         "room_code": room_code, 
-        "p1_name": game['p1_name'], 
-        "p1_avatar": game['p1_avatar'], 
-        "p2_name": game['p2_name'],
-        "p2_avatar": game['p2_avatar'] 
-    })
-
-@app.route("/api/game_status", methods=["GET"])
-def game_status_api():
-    room_code = request.args.get('room_code', '').upper()
-    if room_code not in active_games:
-        if room_code not in active_games:
-            return jsonify({"success": False, "message": "Game not found or has expired."}), 404
+        "p1_name": game.p1_name, 
+        "p1_avatar": game.p1_avatar, 
+        "p2_name": game.p2_name,
+        "p2_avatar": game.p2_avatar 
+    }, 200
+
+def game_status_action(room_code, since):
+    """Full room state, or a delta after `since` (status 304 and no body if unchanged)."""
+    game_state = room_store.get(room_code)
+    if game_state is None:
+        return {"success": False, "message": "Game not found or has expired."}, 404
         
-    game_state = active_games[room_code]
-    return jsonify({"success": True, "game": game_state})
-
-@app.route("/api/reset_round", methods=["POST"])
-def reset_round_api():
-    room_code = request.get_json().get('room_code', '').upper()
-    if room_code not in active_games:
-        return jsonify({"success": False, "message": "Game not found"}), 404
-    
-    game = active_games[room_code]
+    if since >= 0 and game_state.revision <= since:
+        return None, 304
+    return {
+        "success": True,
+        "delta": since >= 0,
+        "revision": game_state.revision,
+        "game": serialize_game(game_state, since)
+    }, 200
+
+def game_updates_action(room_code, since, changed):
+    """Builds the long-poll answer once the server-specific wait has finished."""
+    game_state = room_store.get(room_code)
+    if game_state is None:
+        return {"success": False, "message": "Game not found or has expired."}, 404
+    if not changed:
+        return {"success": True, "changed": False, "revision": since}, 200
+
+    return {
+        "success": True,
+        "changed": True,
+        "delta": since >= 0,
+        "revision": game_state.revision,
+        "game": serialize_game(game_state, since)
+    }, 200
+
+def messages_action(room_code, after):
+    """Cursor-based chat fetch: returns only messages with an id above `after`."""
+    game = room_store.get(room_code)
+    if game is None:
+        return {"success": False, "message": "Game not found or has expired."}, 404
+
+    chat = game.chat_messages
+    messages = chat.after(after)
+    return {
+        "success": True,
+        "messages": [chat_message.to_dict() for chat_message in messages],
+        "cursor": chat.next_seq - 1,
+        "truncated": after + 1 < chat.first_seq # Some requested messages already fell out of the ring
+    }, 200
+
+def round_history_action(room_code, after):
+    """Resolved rounds numbered above `after`, plus the room's running series score."""
+    game = room_store.get(room_code)
+    if game is None:
+        return {"success": False, "message": "Game not found or has expired."}, 404
+
+    return {
+        "success": True,
+        "rounds": game.round_log.after(after),
+        "series": game.series
+    }, 200
+
+def match_ticket_view(ticket):
+    view = {"success": True, "ticket": ticket.id, "status": ticket.status, "tag": ticket.tag}
+    if ticket.status == 'MATCHED':
+        view["room_code"] = ticket.room_code
+        game = room_store.get(ticket.room_code)
+        if game is not None:
+            view.update(p1_name=game.p1_name, p1_avatar=game.p1_avatar,
+                        p2_name=game.p2_name, p2_avatar=game.p2_avatar)
+    elif ticket.status == 'EXPIRED':
+        view["message"] = "No opponent found. Try again."
+    return view
+
+def find_match_action(user_session, data):
+    """Queues the player for a random opponent in the bucket named by `tag`."""
+    player_name = user_session.get('username')
+    player_avatar = user_session.get('avatar') 
+    if not player_name or not player_avatar:
+        return {"success": False, "message": "Not authenticated"}, 403
+
+    tag = str(data.get('tag') or 'any').strip().lower()
+    if len(tag) > MATCH_TAG_MAX_LENGTH:
+        return {"success": False, "message": f"Tag must be {MATCH_TAG_MAX_LENGTH} characters or less."}, 400
+
+    ticket = matchmaker.enqueue(player_name, player_avatar, tag)
+    return match_ticket_view(ticket), 200
+
+def owned_ticket(user_session, ticket_id):
+    """The caller's ticket, or an error (body, status) pair."""
+    ticket = matchmaker.get(ticket_id)
+    if ticket is None:
+        return None, ({"success": False, "message": "Ticket not found or has expired."}, 404)
+    if ticket.username != user_session.get('username'):
+        return None, ({"success": False, "message": "That is not your ticket."}, 403)
+    return ticket, None
+
+def match_status_action(user_session, ticket_id):
+    ticket, error = owned_ticket(user_session, ticket_id)
+    if error:
+        return error
+    return match_ticket_view(ticket), 200
+
+def cancel_match_action(user_session, data):
+    ticket, error = owned_ticket(user_session, data.get('ticket', ''))
+    if error:
+        return error
+    matchmaker.cancel(ticket)
+    return match_ticket_view(ticket), 200
+
+def leaderboard_action(ordering, limit):
+    """The top `limit` players by total wins or by longest win streak."""
+    if ordering not in Leaderboard.ORDERINGS:
+        return {"success": False, "message": "Rank by 'wins' or 'streak'."}, 400
+    limit = max(1, min(limit, LEADERBOARD_MAX_LIMIT))
+    return {"success": True, "by": ordering, "players": leaderboard.top(ordering, limit)}, 200
+
+def reset_round_action(data):
+    room_code = data.get('room_code', '').upper()
+    with room_store.transaction(room_code) as game:
+        if game is None:
+            return {"success": False, "message": "Game not found"}, 404
 
-    if game['status'] != 'RESOLVED':
-        return jsonify({"success": True, "message": "Already reset or not resolved."})
-    
-    game['p1_choice'] = None
-    game['p2_choice'] = None
-    game['result'] = None
-    game['status'] = 'P1_TURN' 
+        if game.status != 'RESOLVED':
+            return {"success": True, "message": "Already reset or not resolved."}, 200
+        
+        game.p1_choice = None
+        game.p2_choice = None
+        game.result = None
+        game.status = game.round_status 
+        mark_changed(game, 'p1_choice', 'p2_choice', 'result', 'status')
     
-    return jsonify({"success": True})
+    return {"success": True}, 200
 
-@app.route("/api/submit_move", methods=["POST"])
-def submit_move():
-    player_name = session.get('username')
+def submit_move_action(user_session, data):
+    player_name = user_session.get('username')
     if not player_name:
-        return jsonify({"error": "Not authenticated"}), 403
+        return {"error": "Not authenticated"}, 403
 
-    data = request.get_json()
     room_code = data.get('room_code', '').upper()
     choice = data.get('choice')
 
-    if room_code not in active_games:
-        return jsonify({"error": "Game not found"}), 404
-    if choice not in VALID_MOVES:
-        return jsonify({"error": "Invalid move choice"}), 400
+    if not isinstance(choice, str) or choice not in VALID_MOVES:
+        return {"error": "Invalid move choice"}, 400
     
-    game = active_games[room_code]
+    with room_store.transaction(room_code) as game:
+        if game is None:
+            return {"error": "Game not found"}, 404
+
+        if game.status == 'P1_TURN' and player_name == game.p1_name:
+            game.p1_choice = choice
+            game.status = 'P2_TURN'
+            mark_changed(game, 'p1_choice', 'status')
+        elif game.status == 'PLAYING' and player_name in (game.p1_name, game.p2_name):
+            # Simultaneous round: moves land in any order, the second one resolves it.
+            field = 'p1_choice' if player_name == game.p1_name else 'p2_choice'
+            if getattr(game, field) is not None:
+                return {"error": "You already moved this round."}, 400
+            setattr(game, field, choice)
+            if game.p1_choice and game.p2_choice:
+                game.record_round()
+                mark_changed(game, 'p1_choice', 'p2_choice', 'status', 'result', 'series')
+            else:
+                mark_changed(game, field)
+        elif game.status == 'P2_TURN' and player_name == game.p2_name:
+            p1c = game.p1_choice
+            p2c = choice
+            
+            if not p1c: 
+                 return {"error": "Waiting for both moves"}, 400
+                 
+            game.p2_choice = p2c
+            game.record_round()
+            mark_changed(game, 'p2_choice', 'status', 'result', 'series')
+        else:
+            return {"error": "It's not your turn or game is over."}, 400
+
+    if game.status == 'RESOLVED': # This move finished the round
+        record_room_round(game)
+    return {"success": True, "message": "Move submitted."}, 200
+
+def admin_authorized(token):
+    return bool(ADMIN_TOKEN) and hmac.compare_digest((token or '').encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def profile_status_action(token):
+    if not admin_authorized(token):
+        return {"success": False, "message": "Admin token required."}, 403
+    return dict(profiler.status(), success=True), 200
+
+def configure_profile_action(token, data):
+    """Sets the sampling rate ({"rate": 0..1}), optionally clears old samples ({"reset": true}), and writes the files."""
+    if not admin_authorized(token):
+        return {"success": False, "message": "Admin token required."}, 403
+    rate = data.get('rate', profiler.rate)
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+        return {"success": False, "message": "Rate must be a number between 0 and 1."}, 400
+
+    if data.get('reset'):
+        profiler.reset()
+    profiler.set_rate(rate)
+    return dict(profiler.status(), success=True, files=profiler.flush()), 200
+
+def send_message_action(user_session, data):
+    player_name = user_session.get('username')
+    if not player_name:
+        return {"success": False, "message": "Not authenticated"}, 403
 
-    if game['status'] == 'P1_TURN' and player_name == game['p1_name']:
-        game['p1_choice'] = choice
-        game['status'] = 'P2_TURN'
-    elif game['status'] == 'P2_TURN' and player_name == game['p2_name']:
-        game['p2_choice'] = choice
-        
-        p1c = game['p1_choice']
-        p2c = game['p2_choice']
-        
-        if not p1c or not p2c: 
-             return jsonify({"error": "Waiting for both moves"}), 400
-             
-        result = decide_winner(p1c, p2c) 
+    room_code = data.get('room_code', '').upper()
+    message_text = data.get('message_text', '').strip()
+
+    if not message_text:
+        return {"success": False, "message": "Message cannot be empty."}, 400
+    if len(message_text) > 200:
+        return {"success": False, "message": "Message too long."}, 400
+    with room_store.transaction(room_code) as game:
+        if game is None:
+            return {"success": False, "message": "Game not found."}, 404
         
-        game['status'] = 'RESOLVED'
-        game['result'] = result
+        game.add_chat_message(player_name, message_text)
+        mark_changed(game, 'chat_messages')
+
+    metrics.inc('rps_chat_messages_total')
+    return {"success": True}, 200
+
+# --- API ROUTES (HTTP Layer) ---
+
+def json_response(body, status):
+    if body is None:
+        return Response(status=status)
+    return jsonify(body), status
+
+def json_body():
+    """The JSON object body, or None if the body is not one (like rock_asgi's Request.json)."""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+def run_json_action(action, *args):
+    """Runs an action on the JSON object body, answering 400 if the body is not one."""
+    data = json_body()
+    if data is None:
+        return json_response({"success": False, "message": "Request body must be a JSON object."}, 400)
+    return json_response(*action(*args, data))
+
+def request_route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_background_fallback():
+    start_background_tasks() # No-op once this process has started them
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if profiler.should_sample():
+        g.profile_ident = profiler.begin(request_route())
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        record_request(request_route(), request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    ident = g.pop('profile_ident', None)
+    if ident is not None:
+        profiler.end(ident)
+
+def long_poll_wait(wait, *args):
+    """Calls wait(*args) with the request's profiling paused.
+
+    A sampled long-poll would otherwise count up to LONG_POLL_TIMEOUT of
+    Condition.wait under its route; rock_asgi leaves those waits unsampled
+    by parking them on the event loop.
+    """
+    ident = g.get('profile_ident')
+    if ident is None:
+        return wait(*args)
+    profiler.end(ident)
+    try:
+        return wait(*args)
+    finally:
+        profiler.begin(request_route())
+
+@app.route("/api/check_name", methods=["GET"])
+def check_name_api():
+    """Checks if a user is already logged in via the session."""
+    return json_response(*check_name_action(session))
+
+@app.route("/api/set_name", methods=["POST"])
+def set_name_api():
+    return run_json_action(set_name_action, session)
+
+@app.route("/api/change_name", methods=["POST"])
+def change_name_api():
+    return json_response(*change_name_action(session))
+
+
+@app.route("/api/play_computer", methods=["POST"])
+def play_computer_api():
+    return run_json_action(play_computer_action, session)
+
+@app.route("/api/play_computer_bulk", methods=["POST"])
+def play_computer_bulk_api():
+    """Plays many computer rounds in one request, in order, with one session update.
+
+    Accepts JSON {"choices": [...], "ai_mode": ...} or an NDJSON body (one
+    choice, or {"p1_choice": ...}, per line). NDJSON requests get NDJSON back.
+    """
+    ndjson = request.mimetype == 'application/x-ndjson'
+    if ndjson:
+        choices = parse_ndjson_choices(request.get_data(as_text=True))
+        if choices is None:
+            return jsonify({"success": False, "message": "Malformed NDJSON body."}), 400
+        ai_mode = request.args.get('ai_mode', AI_DEFAULT_MODE)
     else:
-        return jsonify({"error": "It's not your turn or game is over."}), 400
+        data = json_body()
+        if data is None:
+            return json_response({"success": False, "message": "Request body must be a JSON object."}, 400)
+        choices = data.get('choices')
+        ai_mode = data.get('ai_mode', AI_DEFAULT_MODE)
+
+    body, status = play_computer_bulk_action(session, choices, ai_mode)
+    if ndjson and status == 200:
+        lines = ''.join(json.dumps(round_result) + '\n' for round_result in body['results'])
+        return Response(lines, mimetype='application/x-ndjson')
+    return json_response(body, status)
+
+# --- [ NETWORKED MULTIPLAYER ROUTES ] ---
+
+@app.route("/api/create_room", methods=["POST"])
+def create_room_api():
+    return json_response(*create_room_action(session, json_body() or {}))
+
+@app.route("/api/join_room", methods=["POST"])
+def join_room_api():
+    return run_json_action(join_room_action, session)
+
+@app.route("/api/find_match", methods=["POST"])
+def find_match_api():
+    return json_response(*find_match_action(session, json_body() or {}))
+
+@app.route("/api/match_status", methods=["GET"])
+def match_status_api():
+    """Ticket status; with wait=1 it long-polls until the ticket stops WAITING."""
+    ticket_id = request.args.get('ticket', '')
+    ticket, error = owned_ticket(session, ticket_id) # Only the owner may hold a long-poll on it
+    if error:
+        return json_response(*error)
+    if request.args.get('wait') == '1':
+        long_poll_wait(matchmaker.wait, ticket, LONG_POLL_TIMEOUT)
+    return json_response(*match_status_action(session, ticket_id))
+
+@app.route("/api/cancel_match", methods=["POST"])
+def cancel_match_api():
+    return run_json_action(cancel_match_action, session)
+
+@app.route("/api/game_status", methods=["GET"])
+def game_status_api():
+    room_code = request.args.get('room_code', '').upper()
+    since = request.args.get('since', -1, type=int)
+    return json_response(*game_status_action(room_code, since))
+
+@app.route("/api/game_updates", methods=["GET"])
+def game_updates_api():
+    """Long-poll variant of game_status: answers as soon as the room changes."""
+    room_code = request.args.get('room_code', '').upper()
+    since = request.args.get('since', -1, type=int)
+    if room_code not in room_store:
+        return jsonify({"success": False, "message": "Game not found or has expired."}), 404
+
+    changed = long_poll_wait(room_store.wait_for_change, room_code, since, LONG_POLL_TIMEOUT)
+    return json_response(*game_updates_action(room_code, since, changed))
 
-    return jsonify({"success": True, "message": "Move submitted."})
+@app.route("/api/messages", methods=["GET"])
+def messages_api():
+    room_code = request.args.get('room_code', '').upper()
+    after = request.args.get('after', 0, type=int)
+    return json_response(*messages_action(room_code, after))
+
+@app.route("/api/round_history", methods=["GET"])
+def round_history_api():
+    room_code = request.args.get('room_code', '').upper()
+    after = request.args.get('after', 0, type=int)
+    return json_response(*round_history_action(room_code, after))
+
+@app.route("/api/leaderboard", methods=["GET"])
+def leaderboard_api():
+    ordering = request.args.get('by', 'wins')
+    limit = request.args.get('limit', LEADERBOARD_DEFAULT_LIMIT, type=int)
+    return json_response(*leaderboard_action(ordering, limit))
+
+@app.route("/api/reset_round", methods=["POST"])
+def reset_round_api():
+    return run_json_action(reset_round_action)
+
+@app.route("/api/submit_move", methods=["POST"])
+def submit_move():
+    return run_json_action(submit_move_action, session)
 
 @app.route("/api/send_message", methods=["POST"])
 def send_message_api():
-    player_name = session.get('username')
-    if not player_name:
-        return jsonify({"success": False, "message": "Not authenticated"}), 403
+    return run_json_action(send_message_action, session)
 
-    data = request.get_json()
-    room_code = data.get('room_code', '').upper()
-    message_text = data.get('message_text', '').strip()
+# --- [ OPERATIONS ROUTES ] ---
 
-    if not message_text:
-        return jsonify({"success": False, "message": "Message cannot be empty."}), 400
-    if len(message_text) > 200:
-        return jsonify({"success": False, "message": "Message too long."}), 400
-    if room_code not in active_games:
-        return jsonify({"success": False, "message": "Game not found."}), 404
+@app.route("/metrics", methods=["GET"])
+def metrics_api():
+    """Counters, histograms and gauges in the Prometheus text format."""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
-    game = active_games[room_code]
-    
-    chat_message = {
-        "id": str(uuid.uuid4()),
-        "sender": player_name,
-        "text": message_text,
-        "timestamp": time.time()
-    }
-    game['chat_messages'].append(chat_message)
-    
-    if len(game['chat_messages']) > 50:
-        game['chat_messages'] = game['chat_messages'][-50:]
+@app.route("/admin/profile", methods=["GET"])
+def profile_status_api():
+    return json_response(*profile_status_action(request.headers.get('X-Admin-Token')))
 
-    return jsonify({"success": True})
+@app.route("/admin/profile", methods=["POST"])
+def configure_profile_api():
+    return json_response(*configure_profile_action(request.headers.get('X-Admin-Token'),
+                                                   json_body() or {}))
 
 
 # --- CONTENT FUNCTIONS (Cleaner Structure) ---
@@ -419,6 +3209,7 @@ def get_html_content():
         <h2>Play with a Friend</h2>
         <button id="create-room-btn" class="clickable">Create Room</button>
         <button id="join-room-btn" class="clickable">Join Room</button>
+        <button id="find-match-btn" class="clickable">Random Opponent</button>
         <button class="back-btn clickable" data-target="mode-modal">Back</button>
     </div>
 </div>
@@ -426,12 +3217,20 @@ def get_html_content():
 <div class="modal" id="join-room-modal" style="display:none;">
     <div class="modal-content">
         <h2>Join Room</h2>
-        <input type="text" id="room-code-input" placeholder="Enter 4-Digit Code" maxlength="4" style="text-transform: uppercase;"/>
+        <input type="text" id="room-code-input" placeholder="Enter Room Code" maxlength="8" style="text-transform: uppercase;"/>
         <button id="submit-join-room-btn" class="clickable">Join</button>
         <button class="back-btn clickable" data-target="friend-modal">Back</button>
     </div>
 </div>
 
+<div class="modal" id="match-modal" style="display:none;">
+    <div class="modal-content">
+        <h2>Finding an Opponent...</h2>
+        <p>You will be dropped into a room as soon as someone else is looking too.</p>
+        <button class="back-btn clickable" data-target="friend-modal">Cancel</button>
+    </div>
+</div>
+
 <div class="modal" id="waiting-modal" style="display:none;">
     <div class="modal-content">
         <h2>Waiting for Friend...</h2>
@@ -598,8 +3397,16 @@ let player1Choice = null;
 
 let currentRoomCode = null;
 let myPlayerName = null; 
-let pollingInterval = null; 
+let pollingActive = false; 
+let pollGeneration = 0;
+let pollController = null;
+let gameRevision = -1;
+let roomSocket = null; 
+let socketRequestId = 0;
+const socketReplies = new Map();
 let currentChatMessages = []; 
+let renderedChatIds = new Set();
+let currentGame = null;
 
 const profileUsername = document.getElementById('profile-username');
 const profileAvatar = document.getElementById('profile-avatar'); 
@@ -641,6 +3448,9 @@ const joinRoomModal = document.getElementById('join-room-modal');
 const roomCodeInput = document.getElementById('room-code-input');
 const submitJoinRoomBtn = document.getElementById('submit-join-room-btn');
 const waitingModal = document.getElementById('waiting-modal');
+const findMatchBtn = document.getElementById('find-match-btn');
+const matchModal = document.getElementById('match-modal');
+let matchTicket = null;
 const roomCodeDisplay = document.getElementById('room-code-display');
 
 const chatBoxContainer = document.getElementById('chat-box-container');
@@ -901,10 +3711,27 @@ joinRoomBtn.addEventListener('click', () => {
 
 submitJoinRoomBtn.addEventListener('click', () => {
     const code = roomCodeInput.value.trim().toUpperCase();
-    if (code.length === 4) {
+    if (code.length >= 4 && code.length <= 8) { // Codes grow past 4 characters when the server is busy
         handleJoinRoom(code);
     } else {
-        showToast("Please enter a valid 4-digit code.", "error");
+        showToast("Please enter a valid room code.", "error");
+    }
+});
+
+findMatchBtn.addEventListener('click', () => {
+    friendModal.style.display = 'none';
+    handleFindMatch();
+});
+
+matchModal.querySelector('.back-btn').addEventListener('click', () => {
+    const ticket = matchTicket;
+    matchTicket = null;
+    if (ticket) {
+        fetch('/api/cancel_match', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ ticket: ticket })
+        });
     }
 });
 
@@ -917,7 +3744,11 @@ waitingModal.querySelector('.back-btn').addEventListener('click', () => {
 
 async function handleCreateRoom() {
     try {
-        const response = await fetch('/api/create_room', { method: 'POST' });
+        const response = await fetch('/api/create_room', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ simultaneous: true }) // Both players move at once
+        });
         if (!response.ok) throw new Error('Server error');
         
         const data = await response.json();
@@ -937,6 +3768,54 @@ async function handleCreateRoom() {
     }
 }
 
+async function handleFindMatch() {
+    try {
+        const response = await fetch('/api/find_match', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ tag: 'any' })
+        });
+        let data = await response.json();
+        if (!data.success) {
+            showToast(data.message, "error");
+            friendModal.style.display = 'flex'; 
+            return;
+        }
+
+        const ticket = data.ticket;
+        matchTicket = ticket;
+        matchModal.style.display = 'flex';
+        // Long-poll the ticket; the server answers as soon as we are paired.
+        while (data.success && data.status === 'WAITING' && matchTicket === ticket) {
+            const poll = await fetch(`/api/match_status?ticket=${ticket}&wait=1`);
+            data = await poll.json();
+        }
+        if (matchTicket !== ticket) return; // Cancelled from the modal
+        matchTicket = null;
+        matchModal.style.display = 'none';
+
+        if (data.success && data.status === 'MATCHED') {
+            currentRoomCode = data.room_code;
+            localStorage.setItem('rps_roomCode', currentRoomCode); 
+            player1Name = data.p1_name; 
+            player1Avatar = data.p1_avatar; 
+            player2Name = data.p2_name;
+            player2Avatar = data.p2_avatar; 
+            seriesLength = 0; 
+            startGameUI(); 
+            startPolling(); 
+        } else {
+            showToast(data.message || "Matchmaking stopped.", "info");
+            friendModal.style.display = 'flex'; 
+        }
+    } catch (error) {
+        matchTicket = null;
+        matchModal.style.display = 'none';
+        showToast("Network error finding an opponent.", "error");
+        friendModal.style.display = 'flex'; 
+    }
+}
+
 async function handleJoinRoom(code) {
     try {
         const response = await fetch('/api/join_room', {
@@ -1019,54 +3898,163 @@ function startGameUI() {
 }
 
 function startPolling() {
-    if (pollingInterval) return; 
-    checkGameStatus(); 
-    pollingInterval = setInterval(checkGameStatus, 2500); 
+    if (pollingActive) return; 
+    pollingActive = true;
+    gameRevision = -1;
+    currentGame = null;
+    pollGeneration++;
+    connectRoomChannel(pollGeneration); 
 }
 
 function stopPolling() {
-    clearInterval(pollingInterval);
-    pollingInterval = null;
+    pollingActive = false;
+    pollGeneration++;
+    if (pollController) pollController.abort();
+    pollController = null;
+    if (roomSocket) {
+        const socket = roomSocket;
+        roomSocket = null;
+        socket.close();
+    }
+}
+
+async function connectRoomChannel(generation) {
+    // The room WebSocket when the server speaks it (rock_asgi.py), HTTP long-poll otherwise.
+    if (window.WebSocket && await openRoomSocket(generation)) return;
+    if (pollingActive && generation === pollGeneration) pollLoop(generation);
+}
+
+function openRoomSocket(generation) {
+    // Resolves true once connected, false if the socket could not be opened.
+    return new Promise(resolve => {
+        const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+        const socket = new WebSocket(`${scheme}://${location.host}/api/room_socket?room_code=${currentRoomCode}&since=${gameRevision}`);
+        let opened = false;
+        socket.onopen = () => {
+            opened = true;
+            if (generation === pollGeneration) roomSocket = socket;
+            else socket.close();
+            resolve(true);
+        };
+        socket.onmessage = (event) => handleSocketFrame(JSON.parse(event.data));
+        socket.onclose = () => {
+            if (roomSocket === socket) roomSocket = null;
+            socketReplies.forEach(reply => reply.reject(new Error("Connection lost.")));
+            socketReplies.clear();
+            if (!opened) {
+                resolve(false);
+            } else if (pollingActive && generation === pollGeneration) {
+                pollLoop(generation); // Dropped mid-game: carry on over HTTP
+            }
+        };
+    });
+}
+
+function handleSocketFrame(frame) {
+    if (frame.type === 'state') {
+        if (pollingActive) applyGameUpdate(frame);
+    } else if (frame.type === 'reply') {
+        const reply = socketReplies.get(frame.id);
+        if (!reply) return;
+        socketReplies.delete(frame.id);
+        reply.resolve({ ok: frame.status < 400, data: frame.body });
+    } else if (frame.type === 'closed') {
+        stopPolling();
+        localStorage.removeItem('rps_roomCode'); 
+        showToast(frame.message || "Lost connection to game room.", "error");
+        exitToMenu(); 
+    }
+}
+
+async function roomAction(type, path, payload) {
+    // Sends a move/chat/reset over the room socket if connected, else as a POST.
+    if (roomSocket && roomSocket.readyState === WebSocket.OPEN) {
+        const id = ++socketRequestId;
+        const reply = new Promise((resolve, reject) => socketReplies.set(id, { resolve, reject }));
+        roomSocket.send(JSON.stringify(Object.assign({ type: type, id: id }, payload)));
+        return reply;
+    }
+    const response = await fetch(path, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(Object.assign({ room_code: currentRoomCode }, payload))
+    });
+    return { ok: response.ok, data: await response.json() };
+}
+
+async function pollLoop(generation) {
+    // Long-poll: each request parks on the server until the room changes.
+    while (pollingActive && generation === pollGeneration) {
+        const ok = await checkGameStatus();
+        if (!ok && pollingActive) await wait(2500);
+    }
 }
 
 async function checkGameStatus() {
     if (!currentRoomCode) {
         stopPolling();
-        return;
+        return false;
     }
     
     try {
-        const response = await fetch(`/api/game_status?room_code=${currentRoomCode}`);
+        pollController = new AbortController();
+        const response = await fetch(`/api/game_updates?room_code=${currentRoomCode}&since=${gameRevision}`,
+                                     { signal: pollController.signal });
         if (!response.ok) {
             stopPolling();
             localStorage.removeItem('rps_roomCode'); 
             const errorData = await response.json();
             showToast(errorData.message || "Lost connection to game room.", "error");
             exitToMenu(); 
-            return;
+            return false;
         }
         
         const data = await response.json();
-        if (data.success) {
-            handleGameUpdate(data.game); 
+        if (data.success && data.changed && pollingActive) {
+            applyGameUpdate(data);
         }
+        return data.success;
     } catch (error) {
-        console.error("Polling error:", error);
+        if (error.name !== 'AbortError') console.error("Polling error:", error);
+        return false;
+    }
+}
+
+function applyGameUpdate(data) {
+    // Full snapshots replace our copy; deltas only carry changed fields and new chat.
+    const newMessages = data.game.chat_messages || [];
+    if (!data.delta || !currentGame) {
+        currentGame = data.game;
+    } else {
+        Object.assign(currentGame, data.game);
     }
+    currentGame.chat_messages = newMessages;
+    gameRevision = data.revision;
+    handleGameUpdate(currentGame);
 }
 
 function updateChat(messages) {
-    if (messages.length === currentChatMessages.length) {
+    const newMessages = messages.filter(msg => {
+        if (renderedChatIds.has(msg.id)) return false;
+        renderedChatIds.add(msg.id);
+        // Our own message was already drawn optimistically when we sent it.
+        const pending = currentChatMessages.find(m => m.pending && m.sender === msg.sender && m.text === msg.text);
+        if (pending) {
+            pending.pending = false;
+            return false;
+        }
+        return true;
+    });
+    if (newMessages.length === 0) {
         return; 
     }
 
     const shouldScroll = chatMessagesDiv.scrollTop + chatMessagesDiv.clientHeight >= chatMessagesDiv.scrollHeight - 20;
-
-    const newMessages = messages.slice(currentChatMessages.length);
     
     newMessages.forEach(msg => {
         const msgWrapper = document.createElement('div');
         msgWrapper.className = 'chat-message';
+        msgWrapper.dataset.id = msg.id;
         
         const msgBubble = document.createElement('div');
         msgBubble.className = 'message-bubble';
@@ -1092,7 +4080,7 @@ function updateChat(messages) {
         chatMessagesDiv.appendChild(msgWrapper);
     });
 
-    currentChatMessages = messages; 
+    currentChatMessages = currentChatMessages.concat(newMessages).slice(-50); 
 
     if (shouldScroll) {
         chatMessagesDiv.scrollTop = chatMessagesDiv.scrollHeight;
@@ -1113,10 +4101,19 @@ function handleGameUpdate(game) {
         updateChat(game.chat_messages);
     }
 
+    if (isTwoPlayer && game.series) {
+        // The room keeps the score server-side, so it survives reconnects.
+        player1Score = player1SeriesScore = game.series.p1_wins;
+        player2Score = player2SeriesScore = game.series.p2_wins;
+        updateScoreboard();
+    }
+
+    const myChoice = (myPlayerName === game.p1_name) ? game.p1_choice : game.p2_choice;
     const isMyTurn = (game.status === 'P1_TURN' && myPlayerName === game.p1_name) ||
-                     (game.status === 'P2_TURN' && myPlayerName === game.p2_name);
+                     (game.status === 'P2_TURN' && myPlayerName === game.p2_name) ||
+                     (game.status === 'PLAYING' && !myChoice);
 
-    if (game.status === 'P1_TURN' || game.status === 'P2_TURN') {
+    if (game.status === 'P1_TURN' || game.status === 'P2_TURN' || game.status === 'PLAYING') {
         player1Hand.textContent = game.p1_choice ? '✅' : '❔';
         player2Hand.textContent = game.p2_choice ? '✅' : '❔';
         
@@ -1172,12 +4169,10 @@ function handleGameUpdate(game) {
                 p2CurrentStreak = 0;
             } else if (game.result === 'win') { // P1 (session holder) won
                 p1Wins++;
-                player1SeriesScore++; // Update series score
                 p1CurrentStreak++;
                 p2CurrentStreak = 0;
                 if(p1CurrentStreak > p1LongestStreak) p1LongestStreak = p1LongestStreak;
             } else { // P2 won (game.result === 'lose')
-                player2SeriesScore++; // Update series score
                 p2CurrentStreak++;
                 p1CurrentStreak = 0;
                 if(p2CurrentStreak > p2LongestStreak) p2LongestStreak = p2LongestStreak;
@@ -1193,12 +4188,6 @@ function handleGameUpdate(game) {
                 player1Hand.classList.add('lose-hand');
             }
             
-            if(!tie) {
-                if(game.result === 'win') player1Score++;
-                if(game.result === 'lose') player2Score++;
-            }
-            
-            updateScoreboard(); 
             addToHistory({
                 player1: game.p1_name, player2: game.p2_name,
                 choice1: game.p1_choice, choice2: game.p2_choice,
@@ -1218,11 +4207,7 @@ function handleGameUpdate(game) {
 async function resetRound() {
     if (!currentRoomCode) return;
     try {
-        await fetch('/api/reset_round', {
-             method: 'POST',
-             headers: { 'Content-Type': 'application/json' },
-             body: JSON.stringify({ room_code: currentRoomCode })
-        });
+        await roomAction('reset', '/api/reset_round', {});
         player1Hand.classList.remove('win-hand', 'lose-hand'); 
         player2Hand.classList.remove('win-hand', 'lose-hand'); 
     } catch (error) {
@@ -1239,33 +4224,23 @@ async function sendChatMessage() {
     const tempChatId = `temp_${Math.random()}`; 
     chatInput.value = ''; 
     
-    const messages = [
-        ...currentChatMessages,
-        { id: tempChatId, sender: myPlayerName, text: messageText }
-    ];
-    updateChat(messages);
+    updateChat([{ id: tempChatId, sender: myPlayerName, text: messageText }]);
+    const tempMessage = currentChatMessages.find(m => m.id === tempChatId);
+    if (tempMessage) tempMessage.pending = true;
 
     try {
-        const response = await fetch('/api/send_message', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                room_code: currentRoomCode,
-                message_text: messageText
-            })
-        });
+        const reply = await roomAction('chat', '/api/send_message', { message_text: messageText });
         
-        if (!response.ok) {
-            const errorData = await response.json();
-            throw new Error(errorData.message);
+        if (!reply.ok) {
+            throw new Error(reply.data.message);
         }
         
     } catch (error) {
         showToast(`Error sending message: ${error.message}`, "error");
         chatInput.value = messageText; 
         currentChatMessages = currentChatMessages.filter(m => m.id !== tempChatId);
-        chatMessagesDiv.innerHTML = ''; 
-        updateChat(currentChatMessages); 
+        const tempElement = chatMessagesDiv.querySelector(`[data-id="${tempChatId}"]`);
+        if (tempElement) tempElement.remove(); 
     }
 }
 
@@ -1381,14 +4356,7 @@ async function handleChoice(choice) {
         player1Hand.classList.add('shaking'); 
         
         try {
-            await fetch('/api/submit_move', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    room_code: currentRoomCode,
-                    choice: choice
-                })
-            });
+            await roomAction('move', '/api/submit_move', { choice: choice });
         } catch (error) {
             showToast("Failed to submit move. Please try again.", "error");
             buttons.forEach(btn => btn.disabled = false); 
@@ -1515,6 +4483,7 @@ function resetGame() {
     player2Hand.classList.remove('win-hand', 'lose-hand');
     
     currentChatMessages = [];
+    renderedChatIds = new Set();
     chatMessagesDiv.innerHTML = '';
     
     if(isTwoPlayer) {
@@ -2220,19 +5189,77 @@ h1 { font-size: 1.8rem; }
 """
 
 
+# --- PRE-RENDERED STATIC ASSETS (Built Once at Startup) ---
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+class StaticAsset:
+    """An asset body with precomputed compressed variants and strong ETags."""
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body)
+        self.etags = {encoding: f'{self.version}-{encoding}' for encoding in self.variants}
+
+    def pick_encoding(self, accept_encodings):
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+def build_static_assets():
+    """Renders the page, stylesheet and script once and compresses each of them."""
+    css = StaticAsset(get_css_content().encode('utf-8'), 'text/css')
+    js = StaticAsset(get_js_content().encode('utf-8'), 'application/javascript')
+
+    # Versioned URLs let browsers cache the CSS/JS forever; the page itself is revalidated.
+    html = (get_html_content()
+            .replace('href="/styles.css"', f'href="/styles.css?v={css.version}"')
+            .replace('src="/script.js"', f'src="/script.js?v={js.version}"'))
+    with app.app_context():
+        html = render_template_string(html)
+    page = StaticAsset(html.encode('utf-8'), 'text/html')
+    return {'index': page, 'styles': css, 'script': js}
+
+def serve_static_asset(asset):
+    """Responds with the best encoding the client accepts, or 304 if it is current."""
+    if request.args.get('v') == asset.version:
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = REVALIDATE_CACHE_CONTROL
+
+    encoding = asset.pick_encoding(request.accept_encodings)
+    etag = asset.etags[encoding]
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(asset.variants[encoding], mimetype=asset.mimetype, headers=headers)
+
+STATIC_ASSETS = build_static_assets()
+
+
 # --- FLASK ROUTES FOR SERVING CONTENT ---
 
 @app.route("/")
 def index():
-    return render_template_string(get_html_content())
+    return serve_static_asset(STATIC_ASSETS['index'])
 
 @app.route("/styles.css")
 def styles():
-    return Response(get_css_content(), mimetype="text/css")
+    return serve_static_asset(STATIC_ASSETS['styles'])
 
 @app.route("/script.js")
 def script():
-    return Response(get_js_content(), mimetype="application/javascript")
+    return serve_static_asset(STATIC_ASSETS['script'])
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5002, debug=True)
\ No newline at end of file
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true': # The reloader's serving child, not its file watcher
+        start_worker()
+    app.run(host="0.0.0.0", port=5002, debug=True, threaded=True)
\ No newline at end of file
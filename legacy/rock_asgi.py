@@ -0,0 +1,571 @@
+# Save this file next to rock.py
+# --------------------------------------------------------------------------
+# ROCK PAPER SCISSORS: ASGI SERVER
+# Serves the same page and /api/* contract as rock.py's Flask app from one
+# asyncio event loop. Long-poll clients are parked on asyncio events rather
+# than worker threads, so a single process can hold tens of thousands of
+# players waiting for room updates. Players in a room can also hold a
+# WebSocket (/api/room_socket) that carries moves, chat and pushed state.
+#
+#   uvicorn rock_asgi:app --host 0.0.0.0 --port 5002      (uvicorn[standard] for WebSockets)
+#   hypercorn rock_asgi:app --bind 0.0.0.0:5002
+#
+# Sessions use Flask's signed cookie, so clients can move between the two
+# servers (and share rooms through RPS_ROOM_STORE=sqlite).
+# --------------------------------------------------------------------------
+
+import asyncio
+import contextvars
+import json
+import time
+from urllib.parse import parse_qsl
+
+from flask.sessions import SecureCookieSession
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie, parse_accept_header, parse_cookie, parse_etags
+from werkzeug.utils import get_content_type
+
+import rock
+
+JSON_HEADERS = [('Content-Type', 'application/json')]
+
+
+# --- REQUESTS & SESSIONS ---
+
+class AsgiRequest:
+    """The parts of an HTTP request the game handlers need."""
+
+    def __init__(self, scope, body):
+        self.method = scope.get('method', 'GET') # WebSocket scopes carry no method
+        self.path = scope['path']
+        self.query = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.body = body
+
+    @property
+    def mimetype(self):
+        return self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+    def query_int(self, name, default):
+        try:
+            return int(self.query[name])
+        except (KeyError, ValueError):
+            return default
+
+    def json(self):
+        """The JSON object body, or None if the body is not one."""
+        try:
+            data = json.loads(self.body or b'null')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+def load_session(request):
+    """Reads Flask's signed session cookie, starting a fresh session if it is missing or invalid."""
+    interface = rock.app.session_interface
+    value = parse_cookie(request.headers.get('cookie', '')).get(interface.get_cookie_name(rock.app))
+    if value:
+        max_age = int(rock.app.permanent_session_lifetime.total_seconds())
+        try:
+            return SecureCookieSession(interface.get_signing_serializer(rock.app).loads(value, max_age=max_age))
+        except BadSignature:
+            pass
+    return SecureCookieSession()
+
+def session_cookie_header(user_session):
+    """Set-Cookie header for the session, following the same rules as Flask's save_session."""
+    interface = rock.app.session_interface
+    options = {
+        'domain': interface.get_cookie_domain(rock.app),
+        'path': interface.get_cookie_path(rock.app),
+        'secure': interface.get_cookie_secure(rock.app),
+        'httponly': interface.get_cookie_httponly(rock.app),
+        'samesite': interface.get_cookie_samesite(rock.app),
+    }
+    name = interface.get_cookie_name(rock.app)
+    if not user_session:
+        if user_session.modified:
+            return ('Set-Cookie', dump_cookie(name, '', max_age=0, expires=0, **options))
+        return None
+    if not interface.should_set_cookie(rock.app, user_session):
+        return None
+    value = interface.get_signing_serializer(rock.app).dumps(dict(user_session))
+    expires = interface.get_expiration_time(rock.app, user_session)
+    return ('Set-Cookie', dump_cookie(name, value, expires=expires, **options))
+
+
+# --- LONG-POLL WAKEUPS ---
+
+class RoomEvents:
+    """asyncio.Events for rooms that have parked long-poll clients.
+
+    The room store calls notify() from whichever thread committed the
+    change; the wakeup is handed to the event loop thread-safely.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {} # room_code -> set of asyncio.Event
+
+    def subscribe(self, room_code):
+        event = asyncio.Event()
+        self.waiters.setdefault(room_code, set()).add(event)
+        return event
+
+    def unsubscribe(self, room_code, event):
+        events = self.waiters.get(room_code)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del self.waiters[room_code]
+
+    def notify(self, room_code):
+        if room_code in self.waiters: # Most commits have nobody waiting
+            self.loop.call_soon_threadsafe(self._wake, room_code)
+
+    def _wake(self, room_code):
+        for event in self.waiters.get(room_code, ()):
+            event.set()
+
+room_events = None
+
+def get_room_events():
+    global room_events
+    if room_events is None:
+        room_events = RoomEvents(asyncio.get_running_loop())
+        rock.room_store.listeners.append(room_events.notify)
+        rock.matchmaker.listeners.append(room_events.notify)
+    return room_events
+
+async def wait_for_change(room_code, since, timeout):
+    """Async twin of RoomStore.wait_for_change that parks on an event instead of a thread."""
+    loop = asyncio.get_running_loop()
+    in_memory = isinstance(rock.room_store, rock.InMemoryRoomStore)
+    # Other stores can change underneath us (other workers), so re-check on an interval.
+    check_interval = None if in_memory else rock.ROOM_STORE_POLL_INTERVAL
+    events = get_room_events()
+    event = events.subscribe(room_code) # Subscribe before reading so no commit slips between
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            event.clear()
+            # Only the revision: decoding the whole room on every poll would swamp the executor.
+            if in_memory:
+                revision = rock.room_store.revision(room_code)
+            else:
+                revision = await in_thread(rock.room_store.revision, room_code)
+            if revision is None or revision > since:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), remaining if check_interval is None else min(remaining, check_interval))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        events.unsubscribe(room_code, event)
+
+
+# --- PROFILING ---
+# A request picked by rock.profiler carries its route in this context
+# variable; asyncio.to_thread copies it into the worker thread, where the
+# action runs registered with the profiler. Time spent parked on the event
+# loop is not sampled (it would mix every in-flight request together).
+
+sampled_route = contextvars.ContextVar('sampled_route', default=None)
+
+def sample_request(route):
+    """Marks the current task's request for profiling if the profiler picks it; returns a reset token."""
+    return sampled_route.set(route) if rock.profiler.should_sample() else None
+
+def call_profiled(func, *args):
+    route = sampled_route.get()
+    if route is None:
+        return func(*args)
+    return rock.profiler.run(route, func, *args)
+
+async def in_thread(func, *args):
+    return await asyncio.to_thread(call_profiled, func, *args)
+
+
+# --- API HANDLERS ---
+# Each handler returns (status, headers, body bytes). The game rules live in
+# rock.py's action functions; they run in a worker thread because they take
+# room locks and may touch SQLite.
+
+def json_reply(body, status):
+    if body is None:
+        return status, [], b''
+    return status, JSON_HEADERS, json.dumps(body).encode('utf-8')
+
+def bad_json_reply():
+    return json_reply({"success": False, "message": "Request body must be a JSON object."}, 400)
+
+async def run_action(action, *args):
+    return json_reply(*await in_thread(action, *args))
+
+async def read_room(action, *args):
+    """Room reads never block on the in-memory store (rooms are published copy-on-write)."""
+    if isinstance(rock.room_store, rock.InMemoryRoomStore):
+        return call_profiled(action, *args)
+    return await in_thread(action, *args)
+
+async def run_read_action(action, *args):
+    return json_reply(*await read_room(action, *args))
+
+async def run_json_action(action, request, user_session=None):
+    data = request.json()
+    if data is None:
+        return bad_json_reply()
+    if user_session is None:
+        return await run_action(action, data)
+    return await run_action(action, user_session, data)
+
+async def check_name(request, user_session):
+    return await run_action(rock.check_name_action, user_session)
+
+async def set_name(request, user_session):
+    return await run_json_action(rock.set_name_action, request, user_session)
+
+async def change_name(request, user_session):
+    return await run_action(rock.change_name_action, user_session)
+
+async def play_computer(request, user_session):
+    return await run_json_action(rock.play_computer_action, request, user_session)
+
+async def play_computer_bulk(request, user_session):
+    ndjson = request.mimetype == 'application/x-ndjson'
+    if ndjson:
+        choices = rock.parse_ndjson_choices(request.body.decode('utf-8'))
+        if choices is None:
+            return json_reply({"success": False, "message": "Malformed NDJSON body."}, 400)
+        ai_mode = request.query.get('ai_mode', rock.AI_DEFAULT_MODE)
+    else:
+        data = request.json()
+        if data is None:
+            return bad_json_reply()
+        choices = data.get('choices')
+        ai_mode = data.get('ai_mode', rock.AI_DEFAULT_MODE)
+
+    body, status = await in_thread(rock.play_computer_bulk_action, user_session, choices, ai_mode)
+    if ndjson and status == 200:
+        lines = ''.join(json.dumps(round_result) + '\n' for round_result in body['results'])
+        return 200, [('Content-Type', 'application/x-ndjson')], lines.encode('utf-8')
+    return json_reply(body, status)
+
+async def create_room(request, user_session):
+    return await run_action(rock.create_room_action, user_session, request.json() or {})
+
+async def join_room(request, user_session):
+    return await run_json_action(rock.join_room_action, request, user_session)
+
+async def wait_for_ticket(ticket, timeout):
+    """Parks until a matchmaking ticket stops WAITING (matched, cancelled or expired)."""
+    loop = asyncio.get_running_loop()
+    in_memory = isinstance(rock.room_store, rock.InMemoryRoomStore)
+    # A shared queue can be matched by another worker, so re-read the ticket on an interval.
+    check_interval = None if in_memory else rock.ROOM_STORE_POLL_INTERVAL
+    ticket_id = ticket.id
+    events = get_room_events()
+    event = events.subscribe(ticket_id) # Ticket ids never collide with room codes
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            event.clear()
+            if not in_memory:
+                ticket = await in_thread(rock.matchmaker.get, ticket_id)
+            if ticket is None or ticket.status != 'WAITING':
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), remaining if check_interval is None else min(remaining, check_interval))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        events.unsubscribe(ticket_id, event)
+
+async def find_match(request, user_session):
+    return await run_action(rock.find_match_action, user_session, request.json() or {})
+
+async def match_status(request, user_session):
+    ticket_id = request.query.get('ticket', '')
+    ticket, error = await read_room(rock.owned_ticket, user_session, ticket_id) # Only the owner may wait on it
+    if error:
+        return json_reply(*error)
+    if request.query.get('wait') == '1':
+        await wait_for_ticket(ticket, rock.LONG_POLL_TIMEOUT)
+    return await run_read_action(rock.match_status_action, user_session, ticket_id)
+
+async def cancel_match(request, user_session):
+    return await run_json_action(rock.cancel_match_action, request, user_session)
+
+async def game_status(request, user_session):
+    room_code = request.query.get('room_code', '').upper()
+    return await run_read_action(rock.game_status_action, room_code, request.query_int('since', -1))
+
+async def game_updates(request, user_session):
+    room_code = request.query.get('room_code', '').upper()
+    since = request.query_int('since', -1)
+    if await read_room(rock.room_store.get, room_code) is None:
+        return json_reply({"success": False, "message": "Game not found or has expired."}, 404)
+
+    changed = await wait_for_change(room_code, since, rock.LONG_POLL_TIMEOUT)
+    return await run_read_action(rock.game_updates_action, room_code, since, changed)
+
+async def messages(request, user_session):
+    room_code = request.query.get('room_code', '').upper()
+    return await run_read_action(rock.messages_action, room_code, request.query_int('after', 0))
+
+async def round_history(request, user_session):
+    room_code = request.query.get('room_code', '').upper()
+    return await run_read_action(rock.round_history_action, room_code, request.query_int('after', 0))
+
+async def leaderboard(request, user_session):
+    ordering = request.query.get('by', 'wins')
+    limit = request.query_int('limit', rock.LEADERBOARD_DEFAULT_LIMIT)
+    return await run_action(rock.leaderboard_action, ordering, limit)
+
+async def reset_round(request, user_session):
+    return await run_json_action(rock.reset_round_action, request)
+
+async def submit_move(request, user_session):
+    return await run_json_action(rock.submit_move_action, request, user_session)
+
+async def send_message(request, user_session):
+    return await run_json_action(rock.send_message_action, request, user_session)
+
+def static_reply(request, asset):
+    """Same caching and encoding negotiation as rock.serve_static_asset."""
+    if request.query.get('v') == asset.version:
+        cache_control = rock.IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = rock.REVALIDATE_CACHE_CONTROL
+
+    encoding = asset.pick_encoding(parse_accept_header(request.headers.get('accept-encoding')))
+    etag = asset.etags[encoding]
+    headers = [('ETag', f'"{etag}"'), ('Cache-Control', cache_control), ('Vary', 'Accept-Encoding')]
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return 304, headers, b''
+
+    headers.append(('Content-Type', get_content_type(asset.mimetype, 'utf-8')))
+    if encoding != 'identity':
+        headers.append(('Content-Encoding', encoding))
+    return 200, headers, asset.variants[encoding]
+
+async def metrics(request, user_session):
+    # Collectors may query the SQLite room store, so render off the loop.
+    body = await in_thread(rock.metrics.render)
+    return 200, [('Content-Type', rock.METRICS_CONTENT_TYPE)], body.encode('utf-8')
+
+async def admin_profile(request, user_session):
+    token = request.headers.get('x-admin-token')
+    if request.method == 'GET':
+        return await run_action(rock.profile_status_action, token)
+    return await run_action(rock.configure_profile_action, token, request.json() or {})
+
+def static_handler(name):
+    async def handler(request, user_session):
+        return static_reply(request, rock.STATIC_ASSETS[name])
+    return handler
+
+ROUTES = {
+    '/': ('GET', static_handler('index')),
+    '/styles.css': ('GET', static_handler('styles')),
+    '/script.js': ('GET', static_handler('script')),
+    '/api/check_name': ('GET', check_name),
+    '/api/set_name': ('POST', set_name),
+    '/api/change_name': ('POST', change_name),
+    '/api/play_computer': ('POST', play_computer),
+    '/api/play_computer_bulk': ('POST', play_computer_bulk),
+    '/api/create_room': ('POST', create_room),
+    '/api/join_room': ('POST', join_room),
+    '/api/find_match': ('POST', find_match),
+    '/api/match_status': ('GET', match_status),
+    '/api/cancel_match': ('POST', cancel_match),
+    '/api/game_status': ('GET', game_status),
+    '/api/game_updates': ('GET', game_updates),
+    '/api/messages': ('GET', messages),
+    '/api/round_history': ('GET', round_history),
+    '/api/leaderboard': ('GET', leaderboard),
+    '/api/reset_round': ('POST', reset_round),
+    '/api/submit_move': ('POST', submit_move),
+    '/api/send_message': ('POST', send_message),
+    '/metrics': ('GET', metrics),
+    '/admin/profile': (('GET', 'POST'), admin_profile),
+}
+
+
+# --- ROOM SOCKET ---
+# One WebSocket per player per room (/api/room_socket?room_code=...&since=...).
+# Every frame is a small JSON object. The server pushes the same state
+# payloads as /api/game_updates ({"type": "state", "revision", "delta",
+# "game"}) and answers each client action with {"type": "reply", "id",
+# "status", "body"}. Client actions take the same fields as the HTTP
+# endpoints: {"type": "move", "choice"}, {"type": "chat", "message_text"},
+# {"type": "reset"}; the room code comes from the socket.
+
+ROOM_GONE_CLOSE_CODE = 4404
+NOT_AUTHENTICATED_CLOSE_CODE = 4403
+
+SOCKET_ACTIONS = {
+    'move': rock.submit_move_action,
+    'chat': rock.send_message_action,
+    'reset': lambda user_session, data: rock.reset_round_action(data),
+}
+
+class RoomSocket:
+    """Serializes frames from the reader and pusher tasks onto one connection."""
+
+    def __init__(self, send):
+        self.send = send
+        self.lock = asyncio.Lock()
+        self.closed = False
+
+    async def send_frame(self, frame):
+        async with self.lock:
+            if not self.closed:
+                await self.send({'type': 'websocket.send', 'text': json.dumps(frame, separators=(',', ':'))})
+
+    async def close(self, code):
+        async with self.lock:
+            if not self.closed:
+                self.closed = True
+                await self.send({'type': 'websocket.close', 'code': code})
+
+async def push_room_updates(socket, room_code, since):
+    """Sends a state frame every time the room's revision moves past what the client has."""
+    while True:
+        changed = await wait_for_change(room_code, since, rock.LONG_POLL_TIMEOUT)
+        if not changed:
+            continue
+        body, status = await read_room(rock.game_updates_action, room_code, since, True)
+        if status != 200:
+            await socket.send_frame(dict(body, type='closed'))
+            await socket.close(ROOM_GONE_CLOSE_CODE)
+            return
+        await socket.send_frame(dict(body, type='state'))
+        since = body['revision']
+
+async def handle_socket_frame(socket, user_session, room_code, message):
+    try:
+        frame = json.loads(message.get('text') or message.get('bytes') or b'null')
+    except ValueError:
+        frame = None
+    if not isinstance(frame, dict):
+        return await socket.send_frame({'type': 'reply', 'id': None, 'status': 400,
+                                        'body': {"success": False, "message": "Frames must be JSON objects."}})
+
+    action = SOCKET_ACTIONS.get(frame.get('type'))
+    if action is None:
+        body, status = {"success": False, "message": "Unknown frame type."}, 400
+    else:
+        profile_token = sample_request('/api/room_socket')
+        try:
+            body, status = await in_thread(action, user_session, dict(frame, room_code=room_code))
+        finally:
+            if profile_token is not None:
+                sampled_route.reset(profile_token)
+    await socket.send_frame({'type': 'reply', 'id': frame.get('id'), 'status': status, 'body': body})
+
+async def room_socket(scope, receive, send):
+    request = AsgiRequest(scope, b'')
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    if request.path != '/api/room_socket':
+        return await send({'type': 'websocket.close', 'code': ROOM_GONE_CLOSE_CODE})
+
+    user_session = load_session(request)
+    room_code = request.query.get('room_code', '').upper()
+    if not user_session.get('username'):
+        return await send({'type': 'websocket.close', 'code': NOT_AUTHENTICATED_CLOSE_CODE})
+    if await read_room(rock.room_store.get, room_code) is None:
+        return await send({'type': 'websocket.close', 'code': ROOM_GONE_CLOSE_CODE})
+
+    await send({'type': 'websocket.accept'})
+    socket = RoomSocket(send)
+    pusher = asyncio.ensure_future(push_room_updates(socket, room_code, request.query_int('since', -1)))
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            await handle_socket_frame(socket, user_session, room_code, message)
+    finally:
+        pusher.cancel()
+
+
+# --- ASGI APPLICATION ---
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_reply(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_room_events()
+            await asyncio.to_thread(rock.start_worker)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncio.to_thread(rock.stop_room_snapshots)
+            rock.flush_write_behind()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'websocket':
+        return await room_socket(scope, receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if body is None: # Client went away before sending its request
+        return
+    request = AsgiRequest(scope, body)
+    started = time.perf_counter()
+
+    route = ROUTES.get(request.path)
+    if route is None:
+        rock.record_request('unmatched', request.method, 404, time.perf_counter() - started)
+        return await send_reply(send, 404, [('Content-Type', 'text/plain')], b'Not Found')
+    methods, handler = route
+    if isinstance(methods, str):
+        methods = (methods,)
+    if request.method not in methods:
+        rock.record_request('unmatched', request.method, 405, time.perf_counter() - started)
+        return await send_reply(send, 405, [('Content-Type', 'text/plain'), ('Allow', ', '.join(methods))],
+                                b'Method Not Allowed')
+
+    user_session = load_session(request)
+    profile_token = sample_request(request.path)
+    try:
+        status, headers, payload = await handler(request, user_session)
+    finally:
+        if profile_token is not None:
+            sampled_route.reset(profile_token)
+    cookie = session_cookie_header(user_session)
+    if cookie is not None:
+        headers = headers + [cookie, ('Vary', 'Cookie')]
+    rock.record_request(request.path, request.method, status, time.perf_counter() - started)
+    await send_reply(send, status, headers, payload)
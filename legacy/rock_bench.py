@@ -0,0 +1,380 @@
+# Save this file next to rock.py
+# --------------------------------------------------------------------------
+# ROCK PAPER SCISSORS: LOAD TEST & BENCHMARK HARNESS
+# Simulates N concurrent rooms playing full multiplayer cycles against the
+# rock.py API and reports throughput, per-endpoint p50/p99 latency and
+# memory per room.
+#
+#   python rock_bench.py --rooms 200 --rounds 10            (Flask test client)
+#   python rock_bench.py --rooms 200 --server               (real local server)
+#   python rock_bench.py --rooms 50 --fail-p99-ms 20        (exit 1 on regression)
+#   python rock_bench.py --stress --stress-seconds 10       (thread-safety check)
+# --------------------------------------------------------------------------
+
+import argparse
+import atexit
+import http.client
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('SECRET_KEY', 'rps-bench-secret') # Keep rock.py quiet on import
+
+# The bench signs up hundreds of bench-*/stress-* players; give it a scratch
+# copy of rps_data.db (and a scratch room database) so the tracked files
+# stay clean. Registered before rock's own atexit flushes, so it runs after them.
+_scratch = tempfile.TemporaryDirectory(prefix='rps-bench-')
+atexit.register(_scratch.cleanup)
+if 'RPS_DATABASE' not in os.environ:
+    _database = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rps_data.db')
+    os.environ['RPS_DATABASE'] = os.path.join(_scratch.name, 'rps_data.db')
+    if os.path.exists(_database):
+        source, copy = sqlite3.connect(_database), sqlite3.connect(os.environ['RPS_DATABASE'])
+        source.backup(copy) # Consistent even if a server has the live file open in WAL mode
+        source.close()
+        copy.close()
+os.environ.setdefault('RPS_ROOM_DB', os.path.join(_scratch.name, 'rps_rooms.db'))
+
+import rock
+
+CHOICES = ('rock', 'paper', 'scissors')
+
+
+# --- CLIENTS (Same Interface for Test Client and Real Server) ---
+
+class TestClientSession:
+    """One player talking to the app in-process through Flask's test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, payload=None):
+        response = self.client.open(path, method=method, json=payload)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpSession:
+    """One player talking to a real HTTP server, carrying its session cookie."""
+
+    def __init__(self, host, port):
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, payload=None):
+        headers = {}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        data = response.read()
+        set_cookie = response.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';', 1)[0]
+        try:
+            return response.status, json.loads(data) if data else None
+        except ValueError:
+            return response.status, None
+
+
+# --- MEASUREMENT ---
+
+class LatencyRecorder:
+    """Collects per-endpoint latencies from many worker threads."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def timed(self, session, endpoint, method, path, payload=None, ok_statuses=(200,)):
+        start = time.perf_counter()
+        status, body = session.request(method, path, payload)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(elapsed)
+            if status not in ok_statuses:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return status, body
+
+    def total_requests(self):
+        return sum(len(values) for values in self.samples.values())
+
+    def summary(self):
+        rows = {}
+        for endpoint, values in sorted(self.samples.items()):
+            values = sorted(values)
+            rows[endpoint] = {
+                'count': len(values),
+                'errors': self.errors.get(endpoint, 0),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+            }
+        return rows
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# --- SCENARIO ---
+
+def play_room(make_session, recorder, room_index, rounds, simultaneous=False):
+    """Runs create -> join -> (submit_move, game_status, send_message, reset_round) x rounds."""
+    p1, p2 = make_session(), make_session()
+    recorder.timed(p1, 'set_name', 'POST', '/api/set_name', {'username': f'bench-{room_index}-a', 'avatar': '🤖'})
+    recorder.timed(p2, 'set_name', 'POST', '/api/set_name', {'username': f'bench-{room_index}-b', 'avatar': '👽'})
+
+    _, created = recorder.timed(p1, 'create_room', 'POST', '/api/create_room', {'simultaneous': simultaneous})
+    room_code = created['room_code']
+    recorder.timed(p2, 'join_room', 'POST', '/api/join_room', {'room_code': room_code})
+
+    revision = -1
+    for _ in range(rounds):
+        for player in (p1, p2):
+            recorder.timed(player, 'submit_move', 'POST', '/api/submit_move',
+                           {'room_code': room_code, 'choice': random.choice(CHOICES)})
+            status, body = recorder.timed(player, 'game_status', 'GET',
+                                          f'/api/game_status?room_code={room_code}&since={revision}',
+                                          ok_statuses=(200, 304))
+            if status == 200:
+                revision = body['revision']
+        recorder.timed(p2, 'send_message', 'POST', '/api/send_message',
+                       {'room_code': room_code, 'message_text': 'gg'})
+        recorder.timed(p1, 'reset_round', 'POST', '/api/reset_round', {'room_code': room_code})
+    return room_code
+
+def run_load(make_session, rooms, rounds, concurrency, simultaneous=False):
+    recorder = LatencyRecorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(play_room, make_session, recorder, index, rounds, simultaneous) for index in range(rooms)]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - start
+    return recorder, wall
+
+def measure_memory_per_room(sample_rooms):
+    """Creates idle rooms in-process and reports the traced bytes each one costs."""
+    session = TestClientSession(rock.app)
+    session.request('POST', '/api/set_name', {'username': 'bench-memory', 'avatar': '🤖'})
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(sample_rooms):
+        session.request('POST', '/api/create_room')
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return grown / sample_rooms
+
+
+# --- CONCURRENCY STRESS TEST ---
+
+def check_room_invariants(game):
+    """Returns a description of what is wrong with a room snapshot, or None."""
+    status, p1c, p2c, result = game['status'], game['p1_choice'], game['p2_choice'], game['result']
+    if status == 'P1_TURN' and (p1c or p2c or result):
+        return f"P1_TURN with leftover state {p1c}/{p2c}/{result}"
+    if status == 'P2_TURN' and (not p1c or p2c or result):
+        return f"P2_TURN with choices {p1c}/{p2c}/{result}"
+    if status == 'PLAYING' and (result or (p1c and p2c) or {p1c, p2c} - {None, rock.HIDDEN_CHOICE}):
+        return f"PLAYING with choices {p1c}/{p2c}/{result}"
+    if status == 'RESOLVED' and (not p1c or not p2c or result != rock.decide_winner(p1c, p2c)):
+        return f"RESOLVED with {p1c}/{p2c} -> {result}"
+    ids = [message['id'] for message in game['chat_messages']]
+    if ids != list(range(ids[0], ids[0] + len(ids))) if ids else False:
+        return f"chat ids not contiguous: {ids[:5]}..."
+    return None
+
+def run_stress(rooms, seconds, readers):
+    """Hammers a few rooms from many threads at once and checks every state readers see.
+
+    Both players submit moves as fast as they can, the first player resets
+    resolved rounds, two threads chat, and reader threads poll game_status
+    checking that each snapshot is internally consistent and that revisions
+    never go backwards. Odd-numbered rooms play simultaneous rounds. Expiry
+    sweeps and room churn run alongside, including rooms deleted while a
+    game_updates long-poll is parked on them and chat is waking it.
+    """
+    deadline = time.monotonic() + seconds
+    violations = []
+    sent_messages = {}
+    counters_lock = threading.Lock()
+
+    def new_player(name):
+        session = TestClientSession(rock.app)
+        session.request('POST', '/api/set_name', {'username': name, 'avatar': '🤖'})
+        return session
+
+    def mover(player, room_code, is_p1):
+        while time.monotonic() < deadline:
+            player.request('POST', '/api/submit_move', {'room_code': room_code, 'choice': random.choice(CHOICES)})
+            if is_p1:
+                player.request('POST', '/api/reset_round', {'room_code': room_code})
+
+    def chatter(player, room_code):
+        while time.monotonic() < deadline:
+            status, _ = player.request('POST', '/api/send_message', {'room_code': room_code, 'message_text': 'spam'})
+            if status == 200:
+                with counters_lock:
+                    sent_messages[room_code] = sent_messages.get(room_code, 0) + 1
+
+    def reader(player, room_code):
+        last_revision = -1
+        while time.monotonic() < deadline:
+            _, body = player.request('GET', f'/api/game_status?room_code={room_code}')
+            game = body['game']
+            problem = check_room_invariants(game)
+            if game['revision'] < last_revision:
+                problem = f"revision went back from {last_revision} to {game['revision']}"
+            last_revision = game['revision']
+            if problem:
+                with counters_lock:
+                    violations.append(f"{room_code}: {problem}")
+
+    def churner():
+        player = new_player('stress-churn')
+        while time.monotonic() < deadline:
+            _, body = player.request('POST', '/api/create_room')
+            rock.room_store.delete(body['room_code'])
+            rock.room_store.expire(time.time())
+
+    def vanisher():
+        owner, waiter = new_player('stress-vanish-a'), new_player('stress-vanish-b')
+        while time.monotonic() < deadline:
+            _, body = owner.request('POST', '/api/create_room')
+            room_code = body['room_code']
+            outcome = []
+            poll = threading.Thread(target=lambda: outcome.append(
+                waiter.request('GET', f'/api/game_updates?room_code={room_code}&since=1000000000')[0]))
+            poll.start()
+            time.sleep(0.001) # Let the long-poll park before the room goes away
+            for _ in range(random.randint(0, 3)):
+                owner.request('POST', '/api/send_message', {'room_code': room_code, 'message_text': 'bye'})
+            rock.room_store.delete(room_code)
+            poll.join()
+            if outcome[0] not in (200, 404):
+                with counters_lock:
+                    violations.append(f"{room_code}: game_updates answered {outcome[0]} when the room was deleted")
+
+    threads = []
+    room_codes = []
+    for index in range(rooms):
+        p1, p2 = new_player(f'stress-{index}-a'), new_player(f'stress-{index}-b')
+        _, body = p1.request('POST', '/api/create_room', {'simultaneous': index % 2 == 1})
+        room_code = body['room_code']
+        p2.request('POST', '/api/join_room', {'room_code': room_code})
+        room_codes.append(room_code)
+        threads += [
+            threading.Thread(target=mover, args=(p1, room_code, True)),
+            threading.Thread(target=mover, args=(p2, room_code, False)),
+            threading.Thread(target=chatter, args=(p1, room_code)),
+            threading.Thread(target=chatter, args=(p2, room_code)),
+        ]
+        threads += [threading.Thread(target=reader, args=(new_player(f'stress-{index}-r{r}'), room_code))
+                    for r in range(readers)]
+    threads.append(threading.Thread(target=churner))
+    threads += [threading.Thread(target=vanisher) for _ in range(2)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for room_code in room_codes:
+        game = rock.room_store.get(room_code)
+        stored = game.chat_messages.next_seq - 1
+        if stored != sent_messages.get(room_code, 0):
+            violations.append(f"{room_code}: {sent_messages.get(room_code, 0)} messages accepted but {stored} stored")
+    return violations, len(threads)
+
+
+# --- REPORTING ---
+
+def print_report(summary, wall, total_requests, bytes_per_room):
+    print(f"{'endpoint':<14} {'count':>8} {'errors':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for endpoint, row in summary.items():
+        print(f"{endpoint:<14} {row['count']:>8} {row['errors']:>7} {row['p50_ms']:>9.3f} {row['p99_ms']:>9.3f}")
+    print(f"\n{total_requests} requests in {wall:.2f}s -> {total_requests / wall:.0f} req/s")
+    if bytes_per_room is not None:
+        print(f"memory per idle room: {bytes_per_room:.0f} bytes")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the rock.py game API.")
+    parser.add_argument('--rooms', type=int, default=100, help="rooms to simulate")
+    parser.add_argument('--rounds', type=int, default=5, help="rounds played in each room")
+    parser.add_argument('--concurrency', type=int, default=16, help="rooms played at the same time")
+    parser.add_argument('--simultaneous', action='store_true', help="create rooms where both players move at once")
+    parser.add_argument('--server', action='store_true', help="drive a real local HTTP server instead of the test client")
+    parser.add_argument('--memory-rooms', type=int, default=1000, help="idle rooms created to measure memory (0 to skip)")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--fail-p99-ms', type=float, default=None, help="exit 1 if any endpoint's p99 exceeds this")
+    parser.add_argument('--stress', action='store_true', help="run the concurrency stress test instead of the benchmark")
+    parser.add_argument('--stress-seconds', type=float, default=5, help="how long the stress test runs")
+    parser.add_argument('--stress-readers', type=int, default=4, help="reader threads per stressed room")
+    args = parser.parse_args(argv)
+
+    if args.stress:
+        sys.setswitchinterval(1e-5) # Switch threads often to shake out races
+        violations, thread_count = run_stress(min(args.rooms, 8), args.stress_seconds, args.stress_readers)
+        for violation in violations[:20]:
+            print(violation, file=sys.stderr)
+        print(f"stress: {thread_count} threads, {len(violations)} violations")
+        return 1 if violations else 0
+
+    server = None
+    if args.server:
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR) # No per-request access log
+        server = make_server('127.0.0.1', 0, rock.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+        make_session = lambda: HttpSession('127.0.0.1', port)
+    else:
+        make_session = lambda: TestClientSession(rock.app)
+
+    try:
+        recorder, wall = run_load(make_session, args.rooms, args.rounds, args.concurrency, args.simultaneous)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    bytes_per_room = measure_memory_per_room(args.memory_rooms) if args.memory_rooms else None
+    summary = recorder.summary()
+    total_requests = recorder.total_requests()
+
+    if args.json:
+        print(json.dumps({
+            'endpoints': summary,
+            'wall_seconds': wall,
+            'requests': total_requests,
+            'requests_per_second': total_requests / wall,
+            'bytes_per_room': bytes_per_room,
+        }, indent=2))
+    else:
+        print_report(summary, wall, total_requests, bytes_per_room)
+
+    if args.fail_p99_ms is not None:
+        slow = [name for name, row in summary.items() if row['p99_ms'] > args.fail_p99_ms]
+        if slow:
+            print(f"p99 over {args.fail_p99_ms}ms: {', '.join(slow)}", file=sys.stderr)
+            return 1
+    if any(row['errors'] for row in summary.values()):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())